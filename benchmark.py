@@ -0,0 +1,311 @@
+# 导入所需的库
+import os  # 用于创建合成的文件夹结构
+import sys  # 用于访问命令行参数和修改模块搜索路径
+import time  # 用于计时
+import random  # 用于生成可复现的随机体积数据
+import shutil  # 用于删除临时文件夹
+import io  # 用于把变体内容交给逐行解析器
+import argparse  # 用于解析命令行参数
+import builtins  # 用于统计打开的文件数量
+import resource  # 用于读取进程的峰值内存（仅限类Unix系统）
+import tempfile  # 用于创建默认的工作文件夹
+import subprocess  # 用于在新的解释器中测量导入耗时
+import multiprocessing  # 用于在独立的子进程中测量每个规模，使峰值内存互不影响
+
+# 让脚本在任意工作目录下都能导入同目录的 merge.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import merge  # noqa: E402
+
+
+# --- 合成的 FreeSurfer 文件夹结构 ---
+#
+# 为每个被试生成'<被试>/stats/aseg.stats'和'<被试>/stats/brainvol.stats'，
+# 格式与 FreeSurfer 的输出一致：'# Measure'行、'# ColHeaders'表头和数据行。
+# 另外生成空的'mri/'、'surf/'文件夹，用于检验文件发现阶段的剪枝效果。
+#
+
+# aseg.stats 中的结构名（FreeSurfer 默认输出的子集）
+ASEG_STRUCTURES = [
+    'Left-Lateral-Ventricle', 'Left-Inf-Lat-Vent', 'Left-Cerebellum-White-Matter', 'Left-Cerebellum-Cortex',
+    'Left-Thalamus', 'Left-Caudate', 'Left-Putamen', 'Left-Pallidum', '3rd-Ventricle', '4th-Ventricle',
+    'Brain-Stem', 'Left-Hippocampus', 'Left-Amygdala', 'CSF', 'Left-Accumbens-area', 'Left-VentralDC',
+    'Left-vessel', 'Left-choroid-plexus', 'Right-Lateral-Ventricle', 'Right-Inf-Lat-Vent',
+    'Right-Cerebellum-White-Matter', 'Right-Cerebellum-Cortex', 'Right-Thalamus', 'Right-Caudate',
+    'Right-Putamen', 'Right-Pallidum', 'Right-Hippocampus', 'Right-Amygdala', 'Right-Accumbens-area',
+    'Right-VentralDC', 'Right-vessel', 'Right-choroid-plexus', '5th-Ventricle', 'WM-hypointensities',
+    'non-WM-hypointensities', 'Optic-Chiasm', 'CC_Posterior', 'CC_Mid_Posterior', 'CC_Central',
+    'CC_Mid_Anterior', 'CC_Anterior',
+]
+
+# brainvol.stats 中的'# Measure'行：(度量键, 名称, 描述)，与 merge.BRAINVOL_MEASURES 对应
+BRAINVOL_LINES = [
+    ('BrainSeg', 'BrainSegVol', 'Brain Segmentation Volume'),
+    ('BrainSegNotVent', 'BrainSegVolNotVent', 'Brain Segmentation Volume Without Ventricles'),
+    ('VentricleChoroidVol', 'VentricleChoroidVol', 'Volume of ventricles and choroid plexus'),
+    ('lhCortex', 'lhCortexVol', 'Left hemisphere cortical gray matter volume'),
+    ('rhCortex', 'rhCortexVol', 'Right hemisphere cortical gray matter volume'),
+    ('Cortex', 'CortexVol', 'Total cortical gray matter volume'),
+    ('lhCerebralWhiteMatter', 'lhCerebralWhiteMatterVol', 'Left hemisphere cerebral white matter volume'),
+    ('rhCerebralWhiteMatter', 'rhCerebralWhiteMatterVol', 'Right hemisphere cerebral white matter volume'),
+    ('CerebralWhiteMatter', 'CerebralWhiteMatterVol', 'Total cerebral white matter volume'),
+    ('SubCortGray', 'SubCortGrayVol', 'Subcortical gray matter volume'),
+    ('TotalGray', 'TotalGrayVol', 'Total gray matter volume'),
+    ('SupraTentorial', 'SupraTentorialVol', 'Supratentorial volume'),
+    ('SupraTentorialNotVent', 'SupraTentorialVolNotVent', 'Supratentorial volume'),
+    ('Mask', 'MaskVol', 'Mask Volume'),
+    ('BrainSegNotVentSurf', 'BrainSegVolNotVentSurf', 'Brain Segmentation Volume Without Ventricles from Surf'),
+    ('SupraTentorialNotVentVox', 'SupraTentorialVolNotVentVox', 'Supratentorial volume voxel count'),
+]
+
+
+def write_aseg_stats(path, rng):
+    """写出一个合成的'aseg.stats'文件。"""
+    lines = ['# Title Segmentation Statistics', '#', '# generating_program mri_segstats']
+    for key, name, description in BRAINVOL_LINES[:3]:
+        lines.append(f'# Measure {key}, {name}, {description}, {rng.uniform(1e5, 1.5e6):f}, mm^3')
+    lines.append(f'# Measure EstimatedTotalIntraCranialVol, eTIV, Estimated Total Intracranial Volume, '
+                 f'{rng.uniform(1.2e6, 1.8e6):f}, mm^3')
+    lines.append(f'# NRows {len(ASEG_STRUCTURES)}')
+    lines.append('# NTableCols 10')
+    lines.append('# ColHeaders  Index SegId NVoxels Volume_mm3 StructName normMean normStdDev normMin normMax normRange')
+    for i, struct_name in enumerate(ASEG_STRUCTURES, start=1):
+        volume = rng.uniform(10, 20000)
+        lines.append(f'{i:3d} {i + 3:4d} {int(volume):7d} {volume:9.1f}  {struct_name:<32s} '
+                     f'{rng.uniform(20, 110):8.4f} {rng.uniform(2, 20):8.4f} {rng.uniform(0, 50):8.4f} '
+                     f'{rng.uniform(60, 160):8.4f} {rng.uniform(50, 150):8.4f}')
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def write_brainvol_stats(path, rng):
+    """写出一个合成的'brainvol.stats'文件。"""
+    lines = ['# Title Brain Volume Statistics']
+    for key, name, description in BRAINVOL_LINES:
+        lines.append(f'# Measure {key}, {name}, {description}, {rng.uniform(1e5, 1.5e6):f}, mm^3')
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def generate_tree(root_dir, n_subjects, seed=0):
+    """在'root_dir'下生成包含'n_subjects'个被试的合成 SUBJECTS_DIR。"""
+    rng = random.Random(seed)
+    for i in range(n_subjects):
+        subject_dir = os.path.join(root_dir, f'sub-{i:06d}')
+        stats_dir = os.path.join(subject_dir, 'stats')
+        os.makedirs(stats_dir, exist_ok=True)
+        for name in ('mri', 'surf', 'label', 'scripts'):
+            os.makedirs(os.path.join(subject_dir, name), exist_ok=True)
+        write_aseg_stats(os.path.join(stats_dir, 'aseg.stats'), rng)
+        write_brainvol_stats(os.path.join(stats_dir, 'brainvol.stats'), rng)
+
+
+# --- 分阶段测量 ---
+
+def peak_rss_mb():
+    """返回当前进程到目前为止的峰值常驻内存（MB）。"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是KB，macOS 上是字节
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class OpenCounter:
+    """在'with'块内统计通过内置'open'打开的文件数量。"""
+
+    def __enter__(self):
+        self.count = 0
+        self._open = builtins.open
+
+        def counting_open(*args, **kwargs):
+            self.count += 1
+            return self._open(*args, **kwargs)
+
+        builtins.open = counting_open
+        return self
+
+    def __exit__(self, *exc_info):
+        builtins.open = self._open
+
+
+def measure_stages(root_dir):
+    """
+    依次执行 发现 → 解析 → 聚合 → 写出 四个阶段，返回每个阶段的
+    [(阶段名, 耗时秒数, 阶段结束时的峰值内存MB, 打开的文件数), ...]。
+    """
+    results = []
+    output_path = os.path.join(root_dir, 'total.csv')
+    state = {}
+
+    def discover():
+        state['index'] = merge.build_stats_index(root_dir)
+
+    def parse():
+        state['subject_stats'] = merge.collect_subject_stats(root_dir, index=state['index'])
+
+    def aggregate():
+        # 与 merge_all 相同：组装结构体积、brainvol 指标和表格列
+        state['table'] = merge.build_csv_table(state['subject_stats'])
+
+    def write():
+        # 完整的汇总表只写一次
+        merge.write_csv_table(output_path, state['table'])
+
+    for name, stage in (('discovery', discover), ('parsing', parse), ('aggregation', aggregate), ('writing', write)):
+        with OpenCounter() as counter:
+            start = time.perf_counter()
+            stage()
+            elapsed = time.perf_counter() - start
+        results.append((name, elapsed, peak_rss_mb(), counter.count))
+    return results
+
+
+def _measure_in_child(root_dir, queue):
+    """子进程入口：测量一个规模并把结果放入队列。"""
+    queue.put(measure_stages(root_dir))
+
+
+def run_benchmark(sizes, work_dir, keep=False):
+    """
+    对每个规模生成（或复用）合成文件夹，并在独立的子进程中测量各阶段。
+    返回 {规模: 各阶段结果}。
+    """
+    all_results = {}
+    for n_subjects in sizes:
+        root_dir = os.path.join(work_dir, f'subjects_{n_subjects}')
+        if not os.path.isdir(root_dir):
+            print(f'生成 {n_subjects} 个被试的合成数据: {root_dir}')
+            generate_tree(root_dir, n_subjects)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure_in_child, args=(root_dir, queue))
+        process.start()
+        all_results[n_subjects] = queue.get()
+        process.join()
+        if not keep:
+            shutil.rmtree(root_dir)
+    return all_results
+
+
+# --- 解析器一致性检查 ---
+#
+# merge 的快速路径'_parse_stats_bytes'在遇到不规整的表格时退回逐行解析的'_parse_stats_lines'。
+# 这里对合成的 aseg.stats 及其各种不规整的变体分别用两种解析器解析，检查结果完全相同。
+#
+
+def stats_variants(content):
+    """由一个规整的 aseg.stats 内容生成 {变体名: bytes}，覆盖快速路径需要退回逐行解析的情况。"""
+    lines = content.split(b'\n')
+    header = next(i for i, line in enumerate(lines) if line.startswith(b'# ColHeaders'))
+    first, second = header + 1, header + 2
+    fields = lines[second].split()
+
+    def replace(index, new_line):
+        return b'\n'.join(lines[:index] + [new_line] + lines[index + 1:])
+
+    return {
+        'regular': content,
+        'crlf': content.replace(b'\n', b'\r\n'),
+        'comment_in_data': replace(first, lines[first] + b'\n# comment'),
+        'blank_line': replace(first, lines[first] + b'\n'),
+        'unparsable_number': replace(first, lines[first].replace(lines[first].split()[3], b'n/a', 1)),
+        # 写到一半的文件：被截断到没有结构名的行，以及只截断了后面数值列的行
+        'truncated_before_key': replace(second, b'  '.join(fields[:3])),
+        'truncated_after_key': replace(second, b'  '.join(fields[:5])),
+        'colheaders_in_comment': b'# cmdline see # ColHeaders below\n' + content,
+    }
+
+
+def check_parsers(seed=0):
+    """
+    比较两种解析器在各个变体上的结果（同时检查体积列和位于结构名之后的数值列），
+    返回结果不一致（或抛出异常）的 [(变体名, 数值列), ...]。
+    """
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'aseg.stats')
+        write_aseg_stats(path, rng)
+        with open(path, 'rb') as file:
+            content = file.read()
+    failures = []
+    for name, variant in stats_variants(content).items():
+        for value_columns in (('Volume_mm3',), ('normMean', 'normMax')):
+            try:
+                fast_measures, fast = merge._parse_stats_bytes(variant, 'StructName', value_columns, name)
+                slow_measures, rows = merge._parse_stats_lines(io.StringIO(variant.decode(), newline=None),
+                                                               'StructName', value_columns, name)
+                slow = merge.StatsRecords.from_rows(rows, len(value_columns))
+                # NaN不等于自身，按字符串比较
+                same = (fast_measures == slow_measures and fast.keys == slow.keys
+                        and repr(fast.values.tolist()) == repr(slow.values.tolist()))
+            except Exception:  # noqa: BLE001 - 任何异常都记为不一致
+                same = False
+            if not same:
+                failures.append((name, value_columns))
+    return failures
+
+
+# --- 启动耗时 ---
+
+def measure_import_time(repeats=5):
+    """
+    用'python -X importtime'在新的解释器中导入 merge，重复'repeats'次。
+    返回 (最短的累计导入耗时毫秒, 是否导入了pandas)；第一次运行只用于生成字节码缓存，不计入结果。
+    """
+    command = [sys.executable, '-X', 'importtime', '-c', 'import merge']
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    pandas_imported = False
+    for run in range(repeats + 1):
+        result = subprocess.run(command, cwd=script_dir, capture_output=True, text=True, check=True)
+        # 每行形如 'import time:  自身耗时 | 累计耗时 | 模块名'，耗时单位为微秒
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) != 3 or not line.startswith('import time:'):
+                continue
+            name = fields[2].strip()
+            if name == 'merge':
+                cumulative_us = int(fields[1])
+            elif name == 'pandas':
+                pandas_imported = True
+        if run:
+            timings.append(cumulative_us / 1000)
+    return min(timings), pandas_imported
+
+
+def print_report(all_results):
+    """以表格形式打印测量结果。"""
+    print(f"{'subjects':>9} {'stage':<12} {'wall_s':>9} {'peak_rss_mb':>12} {'files_opened':>13}")
+    for n_subjects, results in all_results.items():
+        for name, elapsed, rss, opened in results:
+            print(f'{n_subjects:>9} {name:<12} {elapsed:>9.3f} {rss:>12.1f} {opened:>13}')
+
+
+# --- 脚本入口点 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='使用合成的 FreeSurfer 数据对 merge.py 的各个阶段计时')
+    parser.add_argument('--sizes', type=lambda text: [int(size) for size in text.split(',')],
+                        default=[100, 1000, 10000, 50000],
+                        help='逗号分隔的被试数量（默认 100,1000,10000,50000）')
+    parser.add_argument('--work-dir', help='存放合成数据的文件夹（默认使用临时文件夹）')
+    parser.add_argument('--keep', action='store_true', help='保留生成的合成数据，下次运行时复用')
+    parser.add_argument('--import-time', action='store_true',
+                        help='只测量 import merge 的启动耗时（python -X importtime），不运行各阶段的测量')
+    parser.add_argument('--check-parsers', action='store_true',
+                        help='只检查快速解析器与逐行解析器在规整和不规整的 stats 文件上结果一致')
+    args = parser.parse_args()
+
+    if args.check_parsers:
+        failures = check_parsers()
+        for name, value_columns in failures:
+            print(f"解析结果不一致: {name} {list(value_columns)}")
+        print('解析器一致' if not failures else f'{len(failures)} 个变体的解析结果不一致')
+        sys.exit(1 if failures else 0)
+
+    if args.import_time:
+        import_ms, pandas_imported = measure_import_time()
+        print(f"import merge: {import_ms:.1f} ms（pandas {'已' if pandas_imported else '未'}导入）")
+        sys.exit(0)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='merge_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    print_report(run_benchmark(args.sizes, work_dir, keep=args.keep))
+    if not args.work_dir and not args.keep:
+        shutil.rmtree(work_dir)  # 删除本次创建的临时文件夹
@@ -1,665 +1,3043 @@
-# 导入所需的库
-import os  # 用于与操作系统交互，如文件路径操作、遍历文件夹等
-import csv  # 用于读写CSV文件
-import pandas as pd  # 强大的数据处理和分析库，这里主要用于数据转置
-import sys  # 用于访问与Python解释器交互的变量和函数，如此处的命令行参数
-
-
-# --- 函数定义部分 ---
-
-# 定义一个函数，用于从FreeSurfer的stats文件中提取数据并存为CSV
-def extract(input_file_path, output_file_path):
-    """
-    读取一个.stats文件，提取表头和数据行，并将其写入一个新的CSV文件。
-    它会忽略以'#'开头的注释行，但专门处理以'# ColHeaders'开头的表头行。
-    """
-    # 使用'with'语句安全地打开输入和输出文件，确保文件最终会被关闭
-    with open(input_file_path) as file:  # 打开原始的.stats文件
-        with open(output_file_path, 'w', newline='') as csvfile:  # 创建并打开用于写入的CSV文件
-            # 'newline='''参数可以防止在写入CSV时出现多余的空行
-            writer = csv.writer(csvfile)  # 创建一个CSV写入对象
-
-            # 遍历输入文件中的每一行
-            for line in file:
-                # 检查行是否是表头定义行
-                if line.startswith('# ColHeaders'):
-                    # 提取表头内容（去除'# ColHeaders'前缀和首尾空格）
-                    title_line = line[len('# ColHeaders'):].strip()
-                    # 将表头字符串按空格分割成字段列表
-                    fields = title_line.rstrip().split()
-                    # 将表头字段写入CSV文件
-                    writer.writerow(fields)
-                # 检查行是否不是注释行（即，行在去除左侧空格后不以'#'开头）
-                elif not line.lstrip().startswith('#'):
-                    # 提取数据行内容（去除末尾的换行符和空格）
-                    fields = line.rstrip().split()
-                    # 将数据字段写入CSV文件
-                    writer.writerow(fields)
-
-
-# 定义一个函数，用于处理指定文件夹下的所有'aseg.stats'文件
-def process_stats_files(folder_path):
-    """
-    遍历指定文件夹及其所有子文件夹，查找名为'aseg.stats'的文件，
-    并使用extract函数将其转换为CSV格式。
-    """
-    # os.walk会递归地遍历文件夹结构
-    for root, dirs, files in os.walk(folder_path):
-        # 遍历当前文件夹下的所有文件名
-        for file_name in files:
-            # 如果文件名是'aseg.stats'
-            if file_name == 'aseg.stats':
-                # 构建该文件的完整路径
-                file_path = os.path.join(root, file_name)
-                # 定义输出的CSV文件名（在原文件名后加上.csv）
-                output_file_path = file_path + '.csv'
-                # 调用extract函数进行转换
-                extract(file_path, output_file_path)
-
-
-# 定义一个函数，用于读取CSV数据，提取特定列，并将其添加到主数据字典中
-def transpose_and_append_column(input_file_path, data, folder_name):
-    """
-    从一个CSV文件中读取'StructName'和'Volume_mm3'列。
-    然后以'StructName'为键，将'Volume_mm3'的值存入一个嵌套字典中。
-    这个结构（data[结构名][被试名] = 体积）便于后续生成汇总表。
-    """
-    # 定义我们感兴趣的列名
-    columns = ['StructName', 'Volume_mm3']
-    # 使用pandas读取CSV文件
-    df = pd.read_csv(input_file_path)
-
-    # 检查CSV文件是否包含所有我们需要的列
-    if not all(col in df.columns for col in columns):
-        print(f"文件 {input_file_path} 中缺少所需的列 {columns}")
-        return  # 如果缺少列，则打印错误信息并跳过此文件
-
-    # 遍历DataFrame的每一行
-    for index, row in df.iterrows():
-        struct_name = row['StructName']  # 获取结构名称
-        volume = row['Volume_mm3']  # 获取对应的体积
-
-        # 如果这个结构名是第一次出现，先在data字典中为它创建一个空字典
-        if struct_name not in data:
-            data[struct_name] = {}
-        # 将当前被试(folder_name)的体积数据存入
-        data[struct_name][folder_name] = volume
-
-
-# 定义一个辅助函数，用于从文件路径中获取上级文件夹的名称
-def get_parent_folder_name(path, levels_up=3):
-    """
-    根据文件路径向上追溯指定层数，获取文件夹名。
-    这里默认'levels_up=3'，是为了从类似 '.../subject_id/stats/aseg.stats.csv' 的路径中提取 'subject_id'。
-    """
-    # 将路径标准化以适应不同操作系统（例如，转换'/'和'\'）并按分隔符分割
-    parts = os.path.normpath(path).split(os.sep)
-    # 如果路径深度足够，返回倒数第'levels_up'个部分，否则返回空字符串
-    return parts[-levels_up] if len(parts) >= levels_up else ''
-
-
-# --- 主逻辑函数 ---
-
-def main(current_folder):
-    """
-    这是脚本的核心执行函数。
-    它协调整个流程：转换.stats文件，聚合数据，最后生成转置后的汇总CSV表。
-    """
-    # 1. 转换所有'aseg.stats'文件为CSV格式
-    process_stats_files(current_folder)
-
-    # 2. 初始化用于存储聚合数据的变量
-    data = {}  # 字典，用于存储所有被试的体积数据
-    folder_names = []  # 列表，用于存储所有被试的ID（文件夹名），以保证最终CSV列的顺序
-    output_path = os.path.join(current_folder, 'total.csv')  # 定义最终输出文件的完整路径
-
-    # 3. 遍历文件夹，读取转换后的CSV，聚合数据
-    for root, dirs, files in os.walk(current_folder):
-        for file_name in files:
-            if file_name == 'aseg.stats.csv':
-                file_path = os.path.join(root, file_name)
-                # 确保不会把最终要生成的总文件当作输入文件来处理
-                if file_path == output_path:
-                    print(f"跳过文件 {file_path}，因为输入路径等于输出路径")
-                    continue
-                # 获取被试ID
-                folder_name = get_parent_folder_name(file_path, levels_up=3)
-                # 将新的被试ID添加到列表中（如果尚未存在）
-                if folder_name not in folder_names:
-                    folder_names.append(folder_name)
-                # 读取该文件的数据并添加到主'data'字典中
-                transpose_and_append_column(file_path, data, folder_name)
-
-    # 4. 将聚合的数据写入初始的'total.csv'文件
-    #    此时的格式是：行为大脑结构，列为被试
-    with open(output_path, 'w', newline='') as file:
-        writer = csv.writer(file)
-        # 写入表头，第一列是'StructName'，其余是各个被试ID
-        headers = ['StructName'] + folder_names
-        writer.writerow(headers)
-        # 遍历'data'字典，写入每一行
-        for struct_name, volumes in data.items():
-            # 构建行数据：结构名 + 对应各个被试的体积（如果某个被试没有该结构的数据，则留空）
-            row = [struct_name] + [volumes.get(folder_name, '') for folder_name in folder_names]
-            writer.writerow(row)
-
-    # 5. 使用pandas进行数据转置，得到最终想要的格式
-    #    最终格式：行为被试，列为大脑结构
-    source_df = pd.read_csv(output_path)  # 读入刚刚创建的CSV
-    transposed_df = source_df.T  # 进行转置操作
-    transposed_df.columns = transposed_df.iloc[0]  # 将转置后的第一行（原来的'StructName'列）设置为新的表头
-    transposed_df = transposed_df[1:]  # 去掉作为表头的那一行
-    # 将转置后的数据写回'total.csv'，'index=True'会把行索引（即被试ID）也写入文件作为第一列
-    transposed_df.to_csv(output_path, index=True, header=True)
-
-
-# --- 从 brainvol.stats 文件提取并追加数据的函数 ---
-#
-# 下面这一系列'process_*'函数遵循完全相同的模式：
-# 1. 遍历文件夹结构，寻找'brainvol.stats'文件。
-# 2. 从文件中找到包含特定关键词的行（例如'Brain Segmentation Volume'）。
-# 3. 解析该行，提取出体积数据。
-# 4. 将被试ID和提取到的体积存入一个'results'字典。
-# 5. 读取现有的'total.csv'文件。
-# 6. 在内存中为数据添加一个新列（即当前函数要提取的指标）。
-# 7. 将更新后的数据完全重写回'total.csv'文件。
-#
-# **注意**: 这种反复读写同一个CSV文件的方式效率较低。如果数据量非常大，
-# 更高效的做法是先提取所有需要的数据到内存中，最后一次性写入CSV。
-# 但对于典型使用场景，这种方法是可行的。
-#
-
-def process_brain_segmentation_volume(root_dir, output_file):
-    """从'brainvol.stats'提取'Brain Segmentation Volume'并追加到汇总文件。"""
-    results = {}  # 存储 {文件夹名: 体积}
-    for subdir, _, files in os.walk(root_dir):
-        if 'brainvol.stats' in files:
-            stats_file_path = os.path.join(subdir, 'brainvol.stats')
-            with open(stats_file_path, 'r') as stats_file:
-                for line in stats_file:
-                    if 'BrainSeg, BrainSegVol, Brain Segmentation Volume' in line:
-                        volume = line.split(',')[3].strip()  # 按逗号分割并取第四个元素
-                        folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                        results[folder_name] = volume
-                        break  # 找到后即可停止读取此文件
-
-    # 读取现有CSV数据
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)  # 读取表头
-        for row in csvreader:
-            rows.append(row)
-
-    # 写入新数据，增加一列
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['Brain Segmentation Volume'])  # 写入新表头
-        for row in rows:
-            folder_name = row[0]  # 第一列是被试ID
-            row.append(results.get(folder_name, 'N/A'))  # 查找并追加体积数据，找不到则填'N/A'
-            csvwriter.writerow(row)
-
-
-# 下面的函数与上面的 `process_brain_segmentation_volume` 结构完全相同，
-# 只是它们搜索的关键词和添加的列名不同。
-
-def process_Brain_Segmentation_Volume_Without_Ventricles(root_dir, output_file):
-    """提取'Brain Segmentation Volume Without Ventricles'并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        if 'brainvol.stats' in files:
-            stats_file_path = os.path.join(subdir, 'brainvol.stats')
-            with open(stats_file_path, 'r') as stats_file:
-                for line in stats_file:
-                    if 'BrainSegNotVent, BrainSegVolNotVent, Brain Segmentation Volume Without Ventricles' in line:
-                        volume = line.split(',')[3].strip()
-                        folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                        results[folder_name] = volume
-                        break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        rows.extend(csvreader)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['Brain Segmentation Volume Without Ventricles'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_SupratentorialVol(root_dir, output_file):
-    """提取'SupratentorialVol' (幕上体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        if 'brainvol.stats' in files:
-            stats_file_path = os.path.join(subdir, 'brainvol.stats')
-            with open(stats_file_path, 'r') as stats_file:
-                for line in stats_file:
-                    if 'SupraTentorial, SupraTentorialVol, Supratentorial volume' in line:
-                        volume = line.split(',')[3].strip()
-                        folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                        results[folder_name] = volume
-                        break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        rows.extend(csvreader)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['SupratentorialVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-# ... (为简洁起见，省略了其余结构相似的 process_* 函数的重复注释) ...
-# 每个函数都执行相同的“查找-提取-追加”逻辑，只是针对不同的度量指标。
-
-def process_SupraTentorialVolNotVent(root_dir, output_file):
-    """提取'SupraTentorialVolNotVent' (不含脑室的幕上体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if ' SupraTentorialNotVent, SupraTentorialVolNotVent, Supratentorial volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['SupraTentorialVolNotVent'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_SubCortGrayVol(root_dir, output_file):
-    """提取'SubCortGrayVol' (皮层下灰质体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'SubCortGray, SubCortGrayVol, Subcortical gray matter volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['SubCortGrayVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_lhCortexVol(root_dir, output_file):
-    """提取'lhCortexVol' (左半球皮层灰质体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'lhCortex, lhCortexVol, Left hemisphere cortical gray matter volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['lhCortexVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_rhCortexVol(root_dir, output_file):
-    """提取'rhCortexVol' (右半球皮层灰质体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'rhCortex, rhCortexVol, Right hemisphere cortical gray matter volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['rhCortexVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_TotalGrayVol(root_dir, output_file):
-    """提取'TotalGrayVol' (总灰质体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'TotalGray, TotalGrayVol, Total gray matter volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['TotalGrayVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_CortexVol(root_dir, output_file):
-    """提取'CortexVol' (总皮层灰质体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if ' Cortex, CortexVol, Total cortical gray matter volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['CortexVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_lhCerebralWhiteMatterVol(root_dir, output_file):
-    """提取'lhCerebralWhiteMatterVol' (左半球大脑白质体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'lhCerebralWhiteMatter, lhCerebralWhiteMatterVol, Left hemisphere cerebral white matter volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['lhCerebralWhiteMatterVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_rhCerebralWhiteMatterVol(root_dir, output_file):
-    """提取'rhCerebralWhiteMatterVol' (右半球大脑白质体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'rhCerebralWhiteMatter, rhCerebralWhiteMatterVol, Right hemisphere cerebral white matter volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['rhCerebralWhiteMatterVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_CerebralWhiteMatterVol(root_dir, output_file):
-    """提取'CerebralWhiteMatterVol' (总大脑白质体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'CerebralWhiteMatter, CerebralWhiteMatterVol, Total cerebral white matter volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['CerebralWhiteMatterVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_MaskVol(root_dir, output_file):
-    """提取'MaskVol' (Mask 体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'Mask, MaskVol, Mask Volume' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['MaskVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_SupraTentorialVolNotVentVox(root_dir, output_file):
-    """提取'SupraTentorialVolNotVentVox' (幕上体积体素计数) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'SupraTentorialNotVentVox, SupraTentorialVolNotVentVox, Supratentorial volume voxel count' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['SupraTentorialVolNotVentVox'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_BrainSegVolNotVentSurf(root_dir, output_file):
-    """提取'BrainSegVolNotVentSurf' (来自表面的不含脑室的脑分割体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'BrainSegNotVentSurf, BrainSegVolNotVentSurf, Brain Segmentation Volume Without Ventricles from Surf' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['BrainSegVolNotVentSurf'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-def process_VentricleChoroidVol(root_dir, output_file):
-    """提取'VentricleChoroidVol' (脑室和脉络丛体积) 并追加。"""
-    results = {}
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file == 'brainvol.stats':
-                stats_file_path = os.path.join(subdir, file)
-                with open(stats_file_path, 'r') as stats_file:
-                    for line in stats_file:
-                        if 'VentricleChoroidVol, VentricleChoroidVol, Volume of ventricles and choroid plexus' in line:
-                            volume = line.split(',')[3].strip()
-                            folder_name = os.path.basename(os.path.dirname(os.path.dirname(stats_file_path)))
-                            results[folder_name] = volume
-                            break
-    rows = []
-    with open(output_file, 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile)
-        headers = next(csvreader)
-        for row in csvreader: rows.append(row)
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(headers + ['VentricleChoroidVol'])
-        for row in rows:
-            folder_name = row[0]
-            row.append(results.get(folder_name, 'N/A'))
-            csvwriter.writerow(row)
-
-
-# --- 脚本入口点 ---
-# 当这个 .py 文件被直接执行时（而不是作为模块导入时），下面的代码块会运行
-if __name__ == "__main__":
-    # 检查命令行参数的数量是否正确
-    # sys.argv 是一个包含命令行参数的列表，第一个元素(sys.argv[0])是脚本名
-    if len(sys.argv) != 2:
-        # 如果参数不等于2（脚本名 + 文件夹路径），则打印用法并退出
-        print("用法: python3 script.py <folder_path>")
-        sys.exit(1)  # 退出脚本，返回状态码1表示错误
-
-    # 获取命令行提供的文件夹路径
-    current_folder = sys.argv[1]
-
-    # 按顺序执行所有处理步骤：
-    # 1. 创建基础的、转置后的 total.csv，包含 aseg.stats 的数据
-    main(current_folder)
-
-    # 2. 逐个调用函数，将 brainvol.stats 中的各项指标追加到 total.csv 中
-    #    每个函数都会读取 total.csv，增加一列，然后再写回文件。
-    output_csv_path = os.path.join(current_folder, 'total.csv')
-    process_brain_segmentation_volume(current_folder, output_csv_path)
-    process_Brain_Segmentation_Volume_Without_Ventricles(current_folder, output_csv_path)
-    process_SupratentorialVol(current_folder, output_csv_path)
-    process_SupraTentorialVolNotVent(current_folder, output_csv_path)
-    process_SubCortGrayVol(current_folder, output_csv_path)
-    process_lhCortexVol(current_folder, output_csv_path)
-    process_rhCortexVol(current_folder, output_csv_path)
-    process_CortexVol(current_folder, output_csv_path)
-    process_TotalGrayVol(current_folder, output_csv_path)
-    process_lhCerebralWhiteMatterVol(current_folder, output_csv_path)
-    process_rhCerebralWhiteMatterVol(current_folder, output_csv_path)
-    process_CerebralWhiteMatterVol(current_folder, output_csv_path)
-    process_MaskVol(current_folder, output_csv_path)
-    process_SupraTentorialVolNotVentVox(current_folder, output_csv_path)
-    process_BrainSegVolNotVentSurf(current_folder, output_csv_path)
-    process_VentricleChoroidVol(current_folder, output_csv_path)
-
-    print(f"处理完成！所有数据已汇总到 {output_csv_path}")
+# 导入所需的库
+import os  # 用于与操作系统交互，如文件路径操作、遍历文件夹等
+import csv  # 用于读写CSV文件
+import numpy as np  # 数值计算库，用于构建 被试×结构 的体积矩阵
+import sys  # 用于访问与Python解释器交互的变量和函数，如此处的命令行参数
+import argparse  # 用于解析命令行参数
+import fnmatch  # 用于按文件名模式匹配stats文件
+import hashlib  # 用于计算stats文件的内容哈希
+import json  # 用于序列化缓存中的解析结果
+import sqlite3  # 用于保存增量解析缓存，以及导出SQLite数据库
+import time  # 用于统计各阶段耗时
+import contextlib  # 用于实现阶段计时的上下文管理器
+import io  # 用于把预读取的文件内容当作文本文件逐行解析
+import tempfile  # 用于在输出文件旁边创建临时文件，写完后原子替换
+import warnings  # 用于屏蔽全为NaN的列在求中位数时的警告
+import re  # 用于按正则表达式或BIDS命名解析被试ID
+import threading  # 用于保护进程内解析结果存储，供多线程的服务共用
+from array import array  # 用于紧凑地保存解析出的数值
+from collections import OrderedDict, deque, namedtuple  # deque用于流式模式中按顺序等待并行任务
+from itertools import islice  # 用于把SQLite插入分批
+from collections.abc import Mapping  # 用于实现紧凑的 brainvol 指标字典
+# 进程池（concurrent.futures.process）只在'jobs' > 1 时按需导入，单被试调用不必承担其导入开销
+from concurrent.futures import ThreadPoolExecutor  # 用于并发预读取stats文件
+
+
+# --- 性能统计 ---
+#
+# 开启'--profile'后记录每个阶段（文件发现、解析、聚合、写出）的耗时，
+# 以及发现/解析/跳过的文件数、读取的字节数、写出的行数等计数，
+# 运行结束时打印汇总表并写出JSON指标文件。还可以选择用cProfile记录函数级耗时，
+# 或用tracemalloc记录每个阶段的内存峰值。
+# 未开启时'stage'返回空的上下文管理器，计数也只在阶段结束时按批累加，几乎没有额外开销。
+#
+
+class Profiler:
+    """收集阶段耗时和计数的统计器，模块级实例为'PROFILER'。"""
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.cpu_profile = None  # 开启cProfile时为 cProfile.Profile 对象
+        self.stages = {}  # {阶段名: 累计耗时秒数}，字典顺序即阶段首次出现的顺序
+        self.memory_peaks = {}  # {阶段名: tracemalloc记录的内存峰值字节数}
+        self.counters = {}  # {计数名: 数值}
+        self.started = None
+
+    def enable(self, cpu=False, memory=False):
+        """开始统计；'cpu'为True时同时运行cProfile，'memory'为True时用tracemalloc记录内存峰值。"""
+        self.enabled = True
+        self.started = time.perf_counter()
+        if memory:
+            import tracemalloc
+            tracemalloc.start()
+            self.trace_memory = True
+        if cpu:
+            import cProfile
+            self.cpu_profile = cProfile.Profile()
+            self.cpu_profile.enable()
+
+    def finish(self):
+        """停止cProfile和tracemalloc。"""
+        if self.cpu_profile is not None:
+            self.cpu_profile.disable()
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.stop()
+
+    def stage(self, name):
+        """返回一个上下文管理器，把其中的耗时累加到阶段'name'。"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed_stage(name)
+
+    @contextlib.contextmanager
+    def _timed_stage(self, name):
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+            if self.trace_memory:
+                import tracemalloc
+                peak = tracemalloc.get_traced_memory()[1]
+                self.memory_peaks[name] = max(self.memory_peaks.get(name, 0), peak)
+
+    def count(self, name, value=1):
+        """把'value'累加到计数'name'。"""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """返回可以序列化为JSON的统计结果。"""
+        stages = {}
+        for name, seconds in self.stages.items():
+            stages[name] = {'seconds': round(seconds, 6)}
+            if name in self.memory_peaks:
+                stages[name]['peak_traced_bytes'] = self.memory_peaks[name]
+        total = time.perf_counter() - self.started if self.started is not None else 0.0
+        return {'total_seconds': round(total, 6), 'stages': stages, 'counters': dict(self.counters)}
+
+    def print_summary(self):
+        """打印各阶段耗时和计数的汇总表。"""
+        report = self.report()
+        print(f"{'阶段':<16}{'耗时(秒)':>12}{'内存峰值(MB)':>16}")
+        for name, stage in report['stages'].items():
+            peak = stage.get('peak_traced_bytes')
+            peak_text = f"{peak / 1024 / 1024:.1f}" if peak is not None else '-'
+            print(f"{name:<16}{stage['seconds']:>12.3f}{peak_text:>16}")
+        print(f"{'total':<16}{report['total_seconds']:>12.3f}")
+        for name, value in report['counters'].items():
+            print(f"{name:<16}{value:>12}")
+        if self.cpu_profile is not None:
+            import pstats
+            pstats.Stats(self.cpu_profile).sort_stats('cumulative').print_stats(15)
+
+    def write(self, metrics_path, pstats_path=None):
+        """写出JSON指标文件；开启cProfile时把原始数据写入'pstats_path'。"""
+        with open(metrics_path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        if self.cpu_profile is not None and pstats_path is not None:
+            self.cpu_profile.dump_stats(pstats_path)
+
+
+# 模块级的统计器，默认关闭
+PROFILER = Profiler()
+
+
+# --- 函数定义部分 ---
+
+# 定义一个函数，用于从FreeSurfer的stats文件中提取数据并存为CSV
+def extract(input_file_path, output_file_path):
+    """
+    读取一个.stats文件，提取表头和数据行，并将其写入一个新的CSV文件。
+    它会忽略以'#'开头的注释行，但专门处理以'# ColHeaders'开头的表头行。
+    """
+    # 使用'with'语句安全地打开输入和输出文件，确保文件最终会被关闭
+    with open(input_file_path) as file:  # 打开原始的.stats文件
+        with open(output_file_path, 'w', newline='') as csvfile:  # 创建并打开用于写入的CSV文件
+            # 'newline='''参数可以防止在写入CSV时出现多余的空行
+            writer = csv.writer(csvfile)  # 创建一个CSV写入对象
+
+            # 遍历输入文件中的每一行
+            for line in file:
+                # 检查行是否是表头定义行
+                if line.startswith('# ColHeaders'):
+                    # 提取表头内容（去除'# ColHeaders'前缀和首尾空格）
+                    title_line = line[len('# ColHeaders'):].strip()
+                    # 将表头字符串按空格分割成字段列表
+                    fields = title_line.rstrip().split()
+                    # 将表头字段写入CSV文件
+                    writer.writerow(fields)
+                # 检查行是否不是注释行（即，行在去除左侧空格后不以'#'开头）
+                elif not line.lstrip().startswith('#'):
+                    # 提取数据行内容（去除末尾的换行符和空格）
+                    fields = line.rstrip().split()
+                    # 将数据字段写入CSV文件
+                    writer.writerow(fields)
+
+
+# 定义一个函数，用于处理指定文件夹下的所有'aseg.stats'文件
+def process_stats_files(folder_path):
+    """
+    遍历指定文件夹及其所有子文件夹，查找名为'aseg.stats'的文件，
+    并使用extract函数将其转换为CSV格式。
+    """
+    # os.walk会递归地遍历文件夹结构
+    for root, dirs, files in os.walk(folder_path):
+        # 遍历当前文件夹下的所有文件名
+        for file_name in files:
+            # 如果文件名是'aseg.stats'
+            if file_name == 'aseg.stats':
+                # 构建该文件的完整路径
+                file_path = os.path.join(root, file_name)
+                # 定义输出的CSV文件名（在原文件名后加上.csv）
+                output_file_path = file_path + '.csv'
+                # 调用extract函数进行转换
+                extract(file_path, output_file_path)
+
+
+# 定义一个函数，所有FreeSurfer stats文件共用的解析器
+def parse_stats_table(input_file_path, key_column=None, value_columns=(), content=None, keys=None):
+    """
+    读取一个FreeSurfer stats文件，同时解析'# Measure'行和'# ColHeaders'之后的表格。
+    返回 (度量字典, 表格记录)：
+    - 度量字典为 {度量键: 数值字符串}，同一个度量键只取第一次出现的值（数值不同时打印提示）；
+    - 表格记录为'StatsRecords'，迭代产出 (键, [数值, ...])，数值按'value_columns'的顺序转换为浮点数。
+    'key_column'为None时不解析表格，表格记录为None；文件中缺少所需的列时表格记录也为None。
+    'content'是已经预读取的文件内容（bytes），传入时不再打开文件。
+    'keys'是需要保留的表格行的键集合，其余行在转换浮点数之前就被跳过；为None时保留所有行。
+    """
+    if content is None:
+        content = read_stats_bytes(input_file_path)
+    return _parse_stats_bytes(content, key_column, value_columns, input_file_path, keys)
+
+
+def read_stats_bytes(input_file_path):
+    """不经过缓冲层，用一次读取把整个stats文件读为bytes。"""
+    with open(input_file_path, 'rb', buffering=0) as file:
+        return file.readall()
+
+
+def _parse_stats_bytes(content, key_column, value_columns, input_file_path, keys=None):
+    """
+    'parse_stats_table'的快速路径：直接在bytes上定位'# Measure'行、'# ColHeaders'行和数据区，
+    数据区只拆分一次，所需的数值列用NumPy一次性转换为浮点数。
+    数据区中有注释行、空行、列数不一致或无法转换的数值时，退回逐行解析的'_parse_stats_lines'。
+    """
+    # 表头行必须在行首；'# ColHeaders'也可能先出现在前面某一行的中间（例如注释中），不能只找第一次出现
+    if content.startswith(b'# ColHeaders'):
+        header_at = 0
+    else:
+        header_at = content.find(b'\n# ColHeaders')
+        if header_at >= 0:
+            header_at += 1
+    measures = {}
+    for line in (content if header_at < 0 else content[:header_at]).split(b'\n'):
+        if line.startswith(b'# Measure'):
+            fields = line[len(b'# Measure'):].split(b',')
+            if len(fields) > 3:
+                _add_measure(measures, fields[0].strip().decode(), fields[3].strip().decode(), input_file_path)
+    if key_column is None or header_at < 0:
+        return measures, None
+
+    line_end = content.find(b'\n', header_at)
+    if line_end < 0:
+        line_end = len(content)
+    headers = content[header_at + len(b'# ColHeaders'):line_end].decode().split()
+    if key_column not in headers or not all(col in headers for col in value_columns):
+        return measures, None
+
+    # 数据区：表头之后的所有行，按列数检查是否是规整的表格
+    data = content[line_end + 1:]
+    tokens = data.split()
+    n_columns = len(headers)
+    n_rows = data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+    if b'#' not in data and len(tokens) == n_rows * n_columns:
+        row_keys = tokens[headers.index(key_column)::n_columns]
+        rows = None  # 需要保留的行号，None表示所有行
+        if keys is not None:
+            # 只比较键的字节，不需要的行既不解码也不转换数值
+            wanted = {key.encode() for key in keys}
+            rows = [i for i, key in enumerate(row_keys) if key in wanted]
+            row_keys = [row_keys[i] for i in rows]
+        try:
+            columns = []
+            for col in value_columns:
+                column_tokens = tokens[headers.index(col)::n_columns]
+                if rows is not None:
+                    column_tokens = [column_tokens[i] for i in rows]
+                columns.append(np.array(column_tokens, dtype=bytes).astype(np.float64))
+        except ValueError:
+            pass  # 有无法转换的数值，交给逐行解析记为NaN
+        else:
+            values = columns[0] if len(columns) == 1 else np.column_stack(columns)
+            return measures, StatsRecords([key.decode() for key in row_keys], values, len(value_columns))
+
+    # newline=None 与文本模式的'open'一样统一换行符
+    measures, records = _parse_stats_lines(io.StringIO(content.decode(), newline=None), key_column, value_columns,
+                                           input_file_path, keys)
+    return measures, StatsRecords.from_rows(records, len(value_columns))
+
+
+def _add_measure(measures, key, value, input_file_path):
+    """记录一个'# Measure'行的数值；同一个度量键再次出现且数值不同时打印提示，保留第一次的值。"""
+    if measures.setdefault(key, value) != value:
+        print(f"文件 {input_file_path} 中度量键 '{key}' 出现多次且数值不同，使用第一次出现的值 {measures[key]}")
+
+
+def _parse_stats_lines(file, key_column, value_columns, input_file_path, keys=None):
+    """
+    逐行解析一个已打开的stats文件，返回 (度量字典, [(键, [数值, ...]), ...] 或None)。
+    'input_file_path'只用于提示信息；'keys'不为None时只保留键在其中的行。
+    """
+    measures = {}
+    records = None
+    key_index = value_indexes = None  # 所需列在数据行中的位置，读到表头行后确定
+    for line in file:
+        # 形如: '# Measure BrainSeg, BrainSegVol, Brain Segmentation Volume, 1243340.000000, mm^3'
+        # 每行只拆分一次，按度量键精确匹配，不再对每个指标做子串查找
+        if line.startswith('# Measure'):
+            fields = line[len('# Measure'):].split(',')
+            if len(fields) > 3:
+                _add_measure(measures, fields[0].strip(), fields[3].strip(), input_file_path)
+        # 表头行：确定所需列的位置
+        elif line.startswith('# ColHeaders'):
+            if key_column is None:
+                break  # 不需要表格，'# Measure'行都在表头之前
+            headers = line[len('# ColHeaders'):].split()
+            if key_column not in headers or not all(col in headers for col in value_columns):
+                break
+            key_index = headers.index(key_column)
+            value_indexes = [headers.index(col) for col in value_columns]
+            records = []
+        # 表头之后的非注释行即为数据行
+        elif records is not None and not line.lstrip().startswith('#'):
+            fields = line.split()
+            # 跳过空行和被截断到没有键的行（例如写到一半的文件）；不需要的行不转换数值
+            if len(fields) > key_index and (keys is None or fields[key_index] in keys):
+                # 被截断的行中缺少的数值记为NaN，与 pandas 补齐短行的行为一致
+                records.append((fields[key_index], [_to_float(fields[i]) if i < len(fields) else float('nan')
+                                                    for i in value_indexes]))
+    return measures, records
+
+
+def _to_float(text):
+    """把表格中的一个单元格转换为浮点数，无法转换时返回NaN。"""
+    try:
+        return float(text)
+    except ValueError:
+        return float('nan')
+
+
+# --- 紧凑的记录表示 ---
+#
+# 汇总十万量级的被试时，解析结果要全部放在内存中。
+# 如果每个被试都保存为 [(结构名, 体积), ...] 列表和 {度量键: 数值} 字典，
+# 每个被试要占用数KB的元组、浮点数对象和字典开销，而其中的结构名、度量键在所有被试之间几乎完全相同。
+# 因此：
+# 1. 键（结构名、度量键）按整个元组驻留，相同布局的被试共用同一个元组对象；
+# 2. 表格数值保存在 array('d') 中，每个数值只占8字节；
+# 3. 记录类使用'__slots__'，没有实例字典。
+# 两个类的迭代和查找方式与原来的列表、字典相同，调用方无需区分；
+# 跨进程传递（pickle）后在主进程中重新驻留键元组，缓存中仍保存为原来的JSON格式。
+#
+
+_INTERNED_KEYS = {}  # {键元组: 驻留的键元组}
+_KEY_POSITIONS = {}  # {id(驻留的键元组): {键: 位置}}，供'MeasureValues'按键查找
+
+
+def intern_keys(keys):
+    """返回与'keys'相等的驻留元组，相同的键序列在整个进程中只保存一份。"""
+    keys = tuple(keys)
+    interned = _INTERNED_KEYS.get(keys)
+    if interned is None:
+        interned = _INTERNED_KEYS[keys] = tuple(sys.intern(key) for key in keys)
+    return interned
+
+
+class StatsRecords:
+    """
+    一个stats表格的紧凑记录：驻留的键元组 + 按行连续存放的 array('d') 数值。
+    'width'为None时每行只有一个数值，迭代产出 (键, 数值)，与 aseg 记录的格式相同；
+    否则每行有'width'个数值，迭代产出 (键, [数值, ...])，与其他表格记录的格式相同。
+    'measures'是 aseg 记录保留的文件头指标（见'ASEG_HEADER_MEASURES'），其他记录为None。
+    """
+    __slots__ = ('keys', 'values', 'width', 'measures')
+
+    def __init__(self, keys, values, width=None, measures=None):
+        self.keys = intern_keys(keys)
+        if isinstance(values, np.ndarray):
+            # NumPy数组按行优先的字节直接复制，不逐个转换
+            self.values = array('d')
+            self.values.frombytes(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        else:
+            self.values = values if isinstance(values, array) else array('d', values)
+        self.width = width
+        self.measures = measures
+
+    @classmethod
+    def from_rows(cls, rows, width=None):
+        """由 [(键, [数值, ...]), ...] 构建；'width'为None时只保留每行的第一个数值。"""
+        if width is None:
+            return cls([key for key, _ in rows], [values[0] for _, values in rows])
+        return cls([key for key, _ in rows], [value for _, values in rows for value in values], width)
+
+    @classmethod
+    def concat(cls, parts):
+        """按顺序拼接多个每行数值个数相同的'StatsRecords'。"""
+        values = array('d')
+        for part in parts:
+            values.extend(part.values)
+        return cls([key for part in parts for key in part.keys], values, parts[0].width)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        if self.width is None:
+            return zip(self.keys, self.values)
+        width = self.width
+        return ((key, self.values[i * width:(i + 1) * width].tolist()) for i, key in enumerate(self.keys))
+
+    def __reduce__(self):
+        # 反序列化时经过'__init__'，键元组在接收方重新驻留
+        return StatsRecords, (self.keys, self.values, self.width, self.measures)
+
+
+class MeasureValues(Mapping):
+    """
+    紧凑的 {度量键: 数值字符串} 只读字典：度量键元组驻留共享，每个被试只保存数值元组。
+    """
+    __slots__ = ('keys_', 'values_')
+
+    def __init__(self, keys, values):
+        self.keys_ = intern_keys(keys)
+        self.values_ = tuple(values)
+
+    @classmethod
+    def from_dict(cls, measures):
+        return cls(measures.keys(), measures.values())
+
+    def _positions(self):
+        positions = _KEY_POSITIONS.get(id(self.keys_))
+        if positions is None:
+            positions = _KEY_POSITIONS[id(self.keys_)] = {key: i for i, key in enumerate(self.keys_)}
+        return positions
+
+    def __getitem__(self, key):
+        return self.values_[self._positions()[key]]
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def __reduce__(self):
+        return MeasureValues, (self.keys_, self.values_)
+
+
+def records_to_json(result):
+    """
+    'json.dumps'的'default'钩子：把紧凑记录转换为原来的列表和字典格式；
+    带有文件头指标的 aseg 记录写为 {'records': [...], 'measures': {...}}。
+    """
+    if isinstance(result, Mapping):
+        return dict(result)
+    if isinstance(result, StatsRecords):
+        if result.measures is not None:
+            return {'records': list(result), 'measures': dict(result.measures)}
+        return list(result)
+    raise TypeError(f'无法序列化 {type(result).__name__}')
+
+
+# aseg.stats 文件头中保留的'# Measure'指标：派生列的参考体积（见'DERIVED_REFERENCES'）。
+# 较新的 FreeSurfer 只在 aseg.stats 中写出 eTIV，brainvol.stats 中没有时由这里补充。
+ASEG_HEADER_MEASURES = ('Mask', 'EstimatedTotalIntraCranialVol')
+
+
+# 定义一个函数，直接在内存中解析'aseg.stats'，提取'StructName'和'Volume_mm3'两列
+def parse_aseg_records(input_file_path, content=None, structures=None):
+    """
+    直接读取一个'aseg.stats'文件，不经过中间的CSV文件。
+    返回紧凑的'StatsRecords'，迭代产出 (结构名, 体积)；如果缺少所需的列则打印提示并返回None。
+    文件头中'ASEG_HEADER_MEASURES'里的指标保存在记录的'measures'中。
+    'content'是已经预读取的文件内容（bytes），传入时不再打开文件。
+    'structures'是需要的结构名集合，提供时只保留这些结构的行。
+    """
+    columns = ['StructName', 'Volume_mm3']
+    measures, records = parse_stats_table(input_file_path, 'StructName', ('Volume_mm3',), content, structures)
+    if records is None:
+        print(f"文件 {input_file_path} 中缺少所需的列 {columns}")
+        return None
+    header = {key: measures[key] for key in ASEG_HEADER_MEASURES if key in measures}
+    # 只有一个数值列，直接共用数值数组，改为每行产出单个数值
+    return StatsRecords(records.keys, records.values, measures=MeasureValues.from_dict(header) if header else None)
+
+
+# 定义一个函数，用于读取CSV数据，提取'StructName'和'Volume_mm3'两列
+def read_aseg_records(input_file_path):
+    """
+    从一个CSV文件中读取'StructName'和'Volume_mm3'列，
+    返回 [(结构名, 体积), ...] 列表；如果缺少所需的列则打印提示并返回None。
+    """
+    # pandas 只在这里和写出 parquet/feather 时使用，按需导入，避免拖慢每次启动
+    import pandas as pd
+
+    # 定义我们感兴趣的列名
+    columns = ['StructName', 'Volume_mm3']
+    # 使用pandas读取CSV文件
+    df = pd.read_csv(input_file_path)
+
+    # 检查CSV文件是否包含所有我们需要的列
+    if not all(col in df.columns for col in columns):
+        print(f"文件 {input_file_path} 中缺少所需的列 {columns}")
+        return None  # 如果缺少列，则打印错误信息并跳过此文件
+
+    # 按行顺序取出 (结构名, 体积)
+    return list(zip(df['StructName'], df['Volume_mm3']))
+
+
+# 定义一个函数，用于把一个被试的 (结构名, 体积) 记录添加到主数据字典中
+def append_records(data, records, folder_name):
+    """
+    以'StructName'为键，将'Volume_mm3'的值存入一个嵌套字典中。
+    这个结构（data[结构名][被试名] = 体积）便于后续生成汇总表。
+    """
+    for struct_name, volume in records:
+        # 如果这个结构名是第一次出现，先在data字典中为它创建一个空字典
+        if struct_name not in data:
+            data[struct_name] = {}
+        # 将当前被试(folder_name)的体积数据存入
+        data[struct_name][folder_name] = volume
+
+
+# 定义一个函数，用于读取CSV数据，提取特定列，并将其添加到主数据字典中
+def transpose_and_append_column(input_file_path, data, folder_name):
+    """
+    从一个CSV文件中读取'StructName'和'Volume_mm3'列，
+    并按 data[结构名][被试名] = 体积 的结构存入主数据字典。
+    开启'STATS_STORE'时，未变化的CSV文件直接复用上次读取的记录。
+    """
+    found = False
+    if STATS_STORE.enabled:
+        found, records = STATS_STORE.get(input_file_path)
+    if not found:
+        records = read_aseg_records(input_file_path)
+        if STATS_STORE.enabled:
+            STATS_STORE.put(input_file_path, records)
+    if records is not None:
+        append_records(data, records, folder_name)
+
+
+# 定义一个辅助函数，用于从文件路径中获取上级文件夹的名称
+def get_parent_folder_name(path, levels_up=3):
+    """
+    根据文件路径向上追溯指定层数，获取文件夹名。
+    这里默认'levels_up=3'，是为了从类似 '.../subject_id/stats/aseg.stats' 的路径中提取 'subject_id'。
+    """
+    # 将路径标准化以适应不同操作系统（例如，转换'/'和'\'）并按分隔符分割
+    parts = os.path.normpath(path).split(os.sep)
+    # 如果路径深度足够，返回倒数第'levels_up'个部分，否则返回空字符串
+    return parts[-levels_up] if len(parts) >= levels_up else ''
+
+
+# 需要解析的stats文件名
+STATS_FILE_NAMES = ('aseg.stats', 'brainvol.stats')
+
+
+# --- 其他stats表格的注册表 ---
+#
+# 除了 aseg.stats 和 brainvol.stats，FreeSurfer 还会生成 aparc、wmparc、海马亚区等stats表格。
+# 它们的格式相同（'# ColHeaders'表头 + 数据行），因此用同一个解析器'parse_stats_table'处理，
+# 只需在下面的注册表中声明：
+#   文件名模式（可含通配符）、键列、数值列、输出列名前缀。
+# 输出列名为 '<前缀><键>_<数值列>'，例如 'lh_superiorfrontal_ThickAvg'。
+# 所有请求的表格与 aseg/brainvol 在同一次遍历中一起解析，增加表格不会增加遍历次数。
+#
+
+StatsTable = namedtuple('StatsTable', ['pattern', 'key_column', 'value_columns', 'prefix'])
+
+# 可通过'--tables'选择的表格，字典顺序即输出列的顺序
+_APARC_COLUMNS = ('ThickAvg', 'SurfArea', 'GrayVol')
+STATS_TABLES = {
+    'lh.aparc': StatsTable('lh.aparc.stats', 'StructName', _APARC_COLUMNS, 'lh_'),
+    'rh.aparc': StatsTable('rh.aparc.stats', 'StructName', _APARC_COLUMNS, 'rh_'),
+    'lh.aparc.a2009s': StatsTable('lh.aparc.a2009s.stats', 'StructName', _APARC_COLUMNS, 'lh_a2009s_'),
+    'rh.aparc.a2009s': StatsTable('rh.aparc.a2009s.stats', 'StructName', _APARC_COLUMNS, 'rh_a2009s_'),
+    'lh.aparc.DKTatlas': StatsTable('lh.aparc.DKTatlas.stats', 'StructName', _APARC_COLUMNS, 'lh_DKT_'),
+    'rh.aparc.DKTatlas': StatsTable('rh.aparc.DKTatlas.stats', 'StructName', _APARC_COLUMNS, 'rh_DKT_'),
+    'wmparc': StatsTable('wmparc.stats', 'StructName', ('Volume_mm3',), ''),
+    'lh.hipposubfields': StatsTable('hipposubfields.lh.T1.*.stats', 'StructName', ('Volume_mm3',), 'lh_hippo_'),
+    'rh.hipposubfields': StatsTable('hipposubfields.rh.T1.*.stats', 'StructName', ('Volume_mm3',), 'rh_hippo_'),
+    'lh.amygdalar-nuclei': StatsTable('amygdalar-nuclei.lh.T1.*.stats', 'StructName', ('Volume_mm3',), 'lh_amyg_'),
+    'rh.amygdalar-nuclei': StatsTable('amygdalar-nuclei.rh.T1.*.stats', 'StructName', ('Volume_mm3',), 'rh_amyg_'),
+}
+
+
+def match_file_names(names, patterns):
+    """按原顺序返回'names'中与任意一个文件名模式匹配的文件名。"""
+    return tuple(name for name in names if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns))
+
+
+def find_stats_table(file_name):
+    """返回与文件名匹配的第一个注册表格的名称，没有匹配时返回None。"""
+    for table_name, table in STATS_TABLES.items():
+        if fnmatch.fnmatchcase(file_name, table.pattern):
+            return table_name
+    return None
+
+
+def stats_file_patterns(tables=()):
+    """返回需要发现的文件名模式：aseg.stats、brainvol.stats 以及所请求表格的文件名模式。"""
+    return STATS_FILE_NAMES + tuple(STATS_TABLES[table_name].pattern for table_name in tables)
+
+
+# --- 文件发现 ---
+#
+# 'os.walk'会进入每个被试的'mri/'、'surf/'、'label/'、'scripts/'等文件夹，
+# 在网络文件系统上产生大量无用的stat调用。这里改用'os.scandir'，
+# 一旦识别出FreeSurfer被试文件夹（含有包含'*.stats'文件的'stats/'），就不再进入其中的其他标准子文件夹。
+# 只有一个'scripts/'或'tmp/'的文件夹（例如研究根目录或站点文件夹）不算被试文件夹；
+# 被试文件夹中的非标准子文件夹也仍会继续向下查找，产出顺序与'os.walk'一致。
+# 发现结果（索引）只构建一次，在各个提取阶段之间共享。
+#
+
+# FreeSurfer 被试文件夹中的标准子文件夹，识别出被试文件夹后不再进入（'stats/'除外）
+FREESURFER_SUBDIRS = frozenset(('mri', 'surf', 'label', 'scripts', 'tmp', 'touch', 'trash'))
+
+
+def iter_stats_dirs(root_dir, file_names=STATS_FILE_NAMES):
+    """
+    按'os.walk'的顺序逐个产出包含stats文件的文件夹：(文件夹路径, 其中需要处理的文件名)。
+    'file_names'是文件名或文件名模式。
+    在被试文件夹中不进入'mri/'、'surf/'等标准子文件夹。
+    这是一个生成器，不会一次性把所有文件夹放入内存。
+    """
+    try:
+        entries = list(os.scandir(root_dir))
+    except OSError:
+        return  # 与'os.walk'一致，无法读取的文件夹直接跳过
+    yield from _iter_scanned_stats_dirs(root_dir, entries, file_names)
+
+
+def _iter_scanned_stats_dirs(root_dir, entries, file_names):
+    """'iter_stats_dirs'的主体，'entries'是已经读取的'root_dir'的目录项。"""
+    # DirEntry 的类型信息来自目录项本身，大多数文件系统上不需要额外的stat调用
+    # 与'os.walk'一致，不进入指向文件夹的符号链接（例如'fsaverage'）
+    subdirs = [entry for entry in entries if entry.is_dir() and not entry.is_symlink()]
+    names = match_file_names([entry.name for entry in entries if not entry.is_dir()], file_names)
+    if names:
+        yield root_dir, names
+
+    # 'stats/'的目录项只读取一次：既用于判断是否为被试文件夹，也用于向下查找
+    stats_entries = None
+    for entry in subdirs:
+        if entry.name == 'stats':
+            try:
+                stats_entries = list(os.scandir(entry.path))
+            except OSError:
+                stats_entries = []
+    if stats_entries and any(item.name.endswith('.stats') and not item.is_dir() for item in stats_entries):
+        # 被试文件夹：跳过标准子文件夹，其余子文件夹仍然向下查找
+        subdirs = [entry for entry in subdirs if entry.name not in FREESURFER_SUBDIRS]
+    for entry in subdirs:
+        if entry.name == 'stats' and stats_entries is not None:
+            yield from _iter_scanned_stats_dirs(entry.path, stats_entries, file_names)
+        else:
+            yield from iter_stats_dirs(entry.path, file_names)
+
+
+def read_name_list(list_file_path):
+    """
+    读取每行一个名称的列表文件，忽略空行和以'#'开头的行。
+    用于被试列表（每行一个相对于根目录的被试文件夹）和结构列表（每行一个结构名）。
+    """
+    with open(list_file_path) as file:
+        return [line.strip() for line in file if line.strip() and not line.lstrip().startswith('#')]
+
+
+def iter_listed_stats_dirs(root_dir, subjects, file_names=STATS_FILE_NAMES):
+    """按列表顺序只检查每个被试的'<被试>/stats/'，不遍历根目录。"""
+    for subject in subjects:
+        stats_dir = os.path.join(root_dir, subject, 'stats')
+        try:
+            files = [entry.name for entry in os.scandir(stats_dir) if not entry.is_dir()]
+        except OSError:
+            print(f"跳过被试 {subject}，因为找不到文件夹 {stats_dir}")
+            continue
+        names = match_file_names(files, file_names)
+        if names:
+            yield stats_dir, names
+
+
+def build_stats_index(root_dir, file_names=STATS_FILE_NAMES, subjects=None):
+    """
+    构建一次stats文件索引：[(文件夹路径, 其中的stats文件名), ...]，按发现顺序排列。
+    'subjects'是被试文件夹列表，提供时只检查这些被试，不遍历根目录。
+    """
+    if subjects is not None:
+        return list(iter_listed_stats_dirs(root_dir, subjects, file_names))
+    return list(iter_stats_dirs(root_dir, file_names))
+
+
+def select_stats_files(index, file_names):
+    """从索引中只保留与'file_names'匹配的文件，去掉因此变为空的文件夹。"""
+    for stats_dir, names in index:
+        selected = match_file_names(names, file_names)
+        if selected:
+            yield stats_dir, selected
+
+
+# --- 按被试并行解析 ---
+#
+# 每个包含stats文件的文件夹（通常是'<被试>/stats'）可以独立解析，互不依赖。
+# 因此先按发现顺序收集所有文件夹，再交给进程池逐个解析，
+# 最后按收集时的顺序合并结果，保证并行输出与串行输出完全一致。
+#
+
+def parse_stats_file(stats_dir, file_name, keep_intermediate=False, content=None, selection=None):
+    """
+    按文件名解析单个stats文件：
+    'aseg.stats'返回aseg记录，'brainvol.stats'返回brainvol指标，
+    其他注册表格返回迭代产出 (键, [数值, ...]) 的'StatsRecords'；缺少所需的列时返回None。
+    'content'是已经预读取的文件内容（bytes），传入时不再打开文件。
+    'selection'是'StatsSelection'，提供时只保留所需的结构和度量键。
+    """
+    path = os.path.join(stats_dir, file_name)
+    if file_name == 'aseg.stats':
+        if keep_intermediate:
+            extract(path, path + '.csv')
+        if skips_file(file_name, selection):
+            return StatsRecords((), ())
+        # 直接在内存中解析，不再从中间CSV文件读回
+        return parse_aseg_records(path, content, selection and selection.structures)
+    if file_name == 'brainvol.stats':
+        return parse_brainvol_measures(path, content, selection and selection.measure_keys)
+
+    table = STATS_TABLES[find_stats_table(file_name)]
+    _, records = parse_stats_table(path, table.key_column, table.value_columns, content)
+    if records is None:
+        print(f"文件 {path} 中缺少所需的列 {[table.key_column] + list(table.value_columns)}")
+    return records
+
+
+def parse_subject_stats(stats_dir, file_names, keep_intermediate=False, contents=None, selection=None):
+    """
+    解析单个文件夹中的stats文件，供并行的工作进程调用。
+    'file_names'是该文件夹中需要处理的文件名。
+    'keep_intermediate'为True时，额外在'aseg.stats'旁边写出'aseg.stats.csv'。
+    'contents'是'read_stats_files'预读取的 {文件名: bytes}，传入时不再打开文件。
+    'selection'是'StatsSelection'，提供时只保留所需的结构和度量键。
+    返回 {文件名: 解析结果}。
+    """
+    contents = contents or {}
+    return {name: parse_stats_file(stats_dir, name, keep_intermediate, contents.get(name), selection)
+            for name in file_names}
+
+
+# --- 并发预读取 ---
+#
+# 在NFS/SMB等高延迟的网络文件系统上，每次'open'都要等待一次往返，
+# 逐个顺序读取时网络链路大部分时间处于空闲状态。
+# 这里用线程池同时读取多个文件夹中的stats文件（同时进行中的读取数有上限），
+# 把原始字节按原顺序交给解析器，使吞吐量受带宽而不是往返延迟限制。
+#
+
+def read_stats_files(stats_dir, file_names, selection=None):
+    """读取一个文件夹中的stats文件，返回 {文件名: bytes}，供线程池调用；按'selection'不需要打开的文件跳过。"""
+    contents = {}
+    for name in file_names:
+        if skips_file(name, selection):
+            continue
+        with open(os.path.join(stats_dir, name), 'rb') as file:
+            contents[name] = file.read()
+    return contents
+
+
+def iter_prefetched(tasks, io_threads, window=None, selection=None):
+    """
+    用'io_threads'个线程并发预读取'tasks'中的 (文件夹路径, 文件名) ，
+    按输入顺序产出 (文件夹路径, 文件名, {文件名: bytes})。
+    同时进行中的读取最多为'window'个（默认为线程数的4倍），内存占用保持有界。
+    'selection'是'StatsSelection'，按它不需要打开的文件不预读取。
+    """
+    window = window or io_threads * 4
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        futures = deque()  # [(文件夹路径, 文件名, future), ...]，按提交顺序排列
+        for stats_dir, names in tasks:
+            futures.append((stats_dir, names, executor.submit(read_stats_files, stats_dir, names, selection)))
+            if len(futures) >= window:
+                stats_dir, names, future = futures.popleft()
+                yield stats_dir, names, future.result()
+        while futures:
+            stats_dir, names, future = futures.popleft()
+            yield stats_dir, names, future.result()
+
+
+def iter_read_tasks(tasks, io_threads=0, selection=None):
+    """'io_threads' > 0 时并发预读取，否则原样产出 (文件夹路径, 文件名, None)，由解析器自己打开文件。"""
+    if io_threads > 0:
+        return iter_prefetched(tasks, io_threads, selection=selection)
+    return ((stats_dir, names, None) for stats_dir, names in tasks)
+
+
+def split_parsed_stats(parsed):
+    """
+    把'parse_subject_stats'的结果拆分为 (aseg记录, brainvol指标, {表格名: 记录})。
+    aseg.stats 或 brainvol.stats 不存在时对应项为None；
+    同一个表格匹配到多个文件时，记录按文件名顺序拼接。
+    """
+    tables = {}
+    for name, result in parsed.items():
+        if name not in STATS_FILE_NAMES and result is not None:
+            tables.setdefault(find_stats_table(name), []).append(result)
+    tables = {table_name: parts[0] if len(parts) == 1 else StatsRecords.concat(parts)
+              for table_name, parts in tables.items()}
+    return parsed.get('aseg.stats'), parsed.get('brainvol.stats'), tables
+
+
+def collect_subject_stats(root_dir, file_names=STATS_FILE_NAMES, jobs=1, keep_intermediate=False, cache=None,
+                          index=None, io_threads=0, selection=None, store=None):
+    """
+    遍历一次文件夹结构，解析其中所有的stats文件。
+    'file_names'是需要解析的文件名或文件名模式（见'stats_file_patterns'）。
+    'keep_intermediate'为True时，额外写出每个被试的'aseg.stats.csv'。
+    'cache'是一个'StatsCache'，传入时只解析新增或发生变化的文件。
+    'store'是进程内的'StatsStore'，不传入时使用已开启的'STATS_STORE'；先查询它，再查询'cache'。
+    'index'是'build_stats_index'的结果，传入时不再重新遍历文件夹。
+    'io_threads' > 0 时用线程池并发预读取文件内容，再交给解析器。
+    'selection'是'StatsSelection'，提供时把结构和度量键的选择下推给解析器；
+    使用缓存或存储时其中保存的是完整的解析结果，因此不下推，由输出阶段再按选择取列。
+    'jobs' > 1 时使用进程池并行解析；无论是否并行，返回结果都按遍历顺序排列：
+    [(文件夹路径, aseg记录, brainvol指标, {表格名: 记录}), ...]
+    """
+    # 1. 按遍历顺序收集需要解析的文件夹
+    if store is None and STATS_STORE.enabled:
+        store = STATS_STORE
+    if cache is not None or store is not None:
+        selection = None
+    if index is None:
+        index = iter_stats_dirs(root_dir, file_names)
+    stats_dirs = []
+    dir_file_names = []
+    for root, names in select_stats_files(index, file_names):
+        stats_dirs.append(root)
+        dir_file_names.append(names)
+
+    # 2. 查询进程内存储和缓存，已保存且未变化的文件直接使用保存的结果
+    parsed = [{} for _ in stats_dirs]  # 与遍历顺序对应的 {文件名: 解析结果}
+    pending = []  # [(序号, 文件夹路径, 需要重新解析的文件名), ...]
+    for i, (stats_dir, names) in enumerate(zip(stats_dirs, dir_file_names)):
+        missing = names
+        if cache is not None or store is not None:
+            missing = []
+            for name in names:
+                path = os.path.join(stats_dir, name)
+                found, result = store.get(path) if store is not None else (False, None)
+                if not found and cache is not None:
+                    found, result = cache.get(path)
+                    if found and store is not None:
+                        store.put(path, result)
+                if found:
+                    parsed[i][name] = result
+                else:
+                    missing.append(name)
+        if missing:
+            pending.append((i, stats_dir, tuple(missing)))
+
+    if PROFILER.enabled:
+        # 只在开启统计时才额外获取文件大小
+        parsed_files = [os.path.join(stats_dir, name) for _, stats_dir, names in pending for name in names]
+        PROFILER.count('files_discovered', sum(len(names) for names in dir_file_names))
+        PROFILER.count('files_parsed', len(parsed_files))
+        PROFILER.count('files_skipped', sum(len(names) for names in dir_file_names) - len(parsed_files))
+        PROFILER.count('bytes_read', sum(os.path.getsize(path) for path in parsed_files))
+
+    # 3. 解析剩余的文件夹（串行或并行）
+    read_tasks = iter_read_tasks(((stats_dir, names) for _, stats_dir, names in pending), io_threads, selection)
+    if jobs > 1 and len(pending) > 1 and io_threads > 0:
+        # 预读取时边读取边提交：同时在处理中的任务数有上限，读取与解析重叠进行，
+        # 父进程中只保留窗口内的文件内容，而不是整个研究的所有stats文件
+        from concurrent.futures import ProcessPoolExecutor
+        window = jobs * 4  # 同时提交给进程池的最大任务数
+        results = []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = deque()  # 按提交顺序排列
+            for stats_dir, names, contents in read_tasks:
+                futures.append(executor.submit(parse_subject_stats, stats_dir, names, keep_intermediate, contents,
+                                               selection))
+                if len(futures) >= window:
+                    results.append(futures.popleft().result())
+            results.extend(future.result() for future in futures)
+    elif jobs > 1 and len(pending) > 1:
+        # 每个工作进程一次领取一批任务，减少进程间通信的开销
+        chunksize = max(1, len(pending) // (jobs * 4))
+        pending_dirs, pending_names, contents = zip(*read_tasks)
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # executor.map 返回结果的顺序与输入顺序一致
+            results = list(executor.map(parse_subject_stats, pending_dirs, pending_names,
+                                        [keep_intermediate] * len(pending), contents,
+                                        [selection] * len(pending), chunksize=chunksize))
+    else:
+        results = [parse_subject_stats(stats_dir, names, keep_intermediate, contents, selection)
+                   for stats_dir, names, contents in read_tasks]
+
+    # 4. 合并解析结果，并写回存储和缓存
+    for (i, stats_dir, names), result in zip(pending, results):
+        parsed[i].update(result)
+        for name in names:
+            if store is not None:
+                store.put(os.path.join(stats_dir, name), result[name])
+            if cache is not None:
+                cache.put(os.path.join(stats_dir, name), result[name])
+    if cache is not None:
+        # 删除已不存在的文件对应的缓存条目
+        cache.evict_except(os.path.join(stats_dir, name)
+                           for stats_dir, names in zip(stats_dirs, dir_file_names) for name in names)
+        cache.commit()
+
+    # 按原文件名顺序整理，保证同一表格的多个文件总是以相同顺序拼接
+    return [(stats_dir,) + split_parsed_stats({name: result[name] for name in names})
+            for stats_dir, names, result in zip(stats_dirs, dir_file_names, parsed)]
+
+
+# --- 增量解析缓存 ---
+#
+# 每次运行都重新解析所有被试的代价与研究规模成正比。
+# 'StatsCache'把每个stats文件的解析结果保存在'total.csv'旁边的SQLite文件中，
+# 以 (文件路径, 修改时间, 文件大小[, 内容哈希]) 判断文件是否发生变化，
+# 重新运行时只解析新增或变化的文件，并清除已删除文件的条目。
+#
+
+# 缓存文件名，保存在输出文件所在的文件夹中
+CACHE_FILE_NAME = 'total.cache.sqlite'
+
+
+class StatsCache:
+    """
+    stats文件解析结果的持久化缓存。
+    'root_dir'用于把文件路径转换为相对路径作为键；
+    'use_hash'为True时额外比较文件内容的SHA-1，修改时间不可靠时使用。
+    """
+
+    def __init__(self, cache_path, root_dir, use_hash=False):
+        self.root_dir = root_dir
+        self.use_hash = use_hash
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS stats_cache ('
+            'path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT, payload TEXT)')
+        # 一次性读出全部条目，避免逐个文件查询数据库
+        self.entries = {
+            path: (mtime_ns, size, digest, payload)
+            for path, mtime_ns, size, digest, payload
+            in self.connection.execute('SELECT path, mtime_ns, size, digest, payload FROM stats_cache')
+        }
+        self.signatures = {}  # {键: 本次运行读取到的文件签名}，供'put'使用
+
+    def _key(self, path):
+        """把文件路径转换为相对于根目录的缓存键。"""
+        return os.path.relpath(path, self.root_dir)
+
+    def _signature(self, path):
+        """返回文件的签名 (修改时间, 大小, 内容哈希)，不计算哈希时哈希为None。"""
+        stat = os.stat(path)
+        digest = None
+        if self.use_hash:
+            with open(path, 'rb') as file:
+                digest = hashlib.sha1(file.read()).hexdigest()
+        return stat.st_mtime_ns, stat.st_size, digest
+
+    def get(self, path):
+        """
+        查询文件的缓存结果，返回 (是否命中, 解析结果)。
+        启用哈希时只要内容未变即视为命中，否则要求修改时间和大小都未变。
+        """
+        key = self._key(path)
+        signature = self._signature(path)
+        self.signatures[key] = signature
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        mtime_ns, size, digest, payload = entry
+        if self.use_hash:
+            hit = digest == signature[2]
+        else:
+            hit = (mtime_ns, size) == signature[:2]
+        if not hit:
+            return False, None
+        if (mtime_ns, size, digest) != signature:
+            # 内容未变但修改时间等发生变化时，更新签名以便下次快速命中
+            self.connection.execute('UPDATE stats_cache SET mtime_ns = ?, size = ?, digest = ? WHERE path = ?',
+                                    signature + (key,))
+        return True, self._decode(json.loads(payload))
+
+    def put(self, path, result):
+        """保存一个文件的解析结果，签名使用'get'时读取到的值。"""
+        key = self._key(path)
+        signature = self.signatures.pop(key, None) or self._signature(path)
+        payload = json.dumps(result, default=records_to_json)
+        self.connection.execute('INSERT OR REPLACE INTO stats_cache VALUES (?, ?, ?, ?, ?)',
+                                (key,) + signature + (payload,))
+        self.entries[key] = signature + (payload,)
+
+    def evict_except(self, paths):
+        """
+        删除对应文件已被删除的条目。'paths'是本次发现的文件，这些条目一定保留；
+        其余条目（例如被被试列表或 --measures 排除在本次运行之外的文件）只有在文件确实不存在时才删除。
+        """
+        keep = {self._key(path) for path in paths}
+        stale = [key for key in self.entries
+                 if key not in keep and not os.path.exists(os.path.join(self.root_dir, key))]
+        self.connection.executemany('DELETE FROM stats_cache WHERE path = ?', [(key,) for key in stale])
+        for key in stale:
+            del self.entries[key]
+
+    def commit(self):
+        """提交本次运行对缓存的所有修改。"""
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    @staticmethod
+    def _decode(result):
+        """把JSON中的记录列表和指标字典还原为紧凑的'StatsRecords'和'MeasureValues'。"""
+        if isinstance(result, dict) and isinstance(result.get('records'), list):
+            # 带有文件头指标的 aseg 记录
+            records = StatsCache._decode(result['records'])
+            records.measures = MeasureValues.from_dict(result['measures'])
+            return records
+        if isinstance(result, dict):
+            return MeasureValues.from_dict(result)
+        if isinstance(result, list):
+            # 表格记录的每行是数值列表，aseg 记录的每行是单个数值
+            if result and isinstance(result[0][1], list):
+                return StatsRecords.from_rows(result, len(result[0][1]))
+            return StatsRecords([key for key, _ in result], [value for _, value in result])
+        return result
+
+
+# --- 进程内解析结果存储 ---
+#
+# 在 Jupyter 或常驻的 QC 服务中反复调用'main'、'process_*'、'merge_all'时，
+# 每次调用都会重新读取和解析同一个研究文件夹中的所有文件。
+# 'StatsStore'是进程内的LRU存储：按文件路径保存解析结果，并记录解析时的 (mtime_ns, 大小)，
+# 文件未变化时直接复用，变化后自动失效并重新解析；估算的总内存超过上限时淘汰最久未使用的条目。
+# 模块级的'STATS_STORE'默认关闭，调用'STATS_STORE.enable()'后所有库函数共用它；
+# 也可以创建单独的'StatsStore'作为'collect_subject_stats'的'store'参数传入。
+# 文件夹的遍历仍然每次进行（只有 scandir，没有读取文件），新增或删除的被试因此总能被发现。
+#
+
+# 'StatsStore'默认的内存上限（估算值）
+DEFAULT_STORE_BYTES = 256 * 1024 * 1024
+# 每个条目除解析结果以外的固定开销估算：路径字符串、签名元组和LRU链表节点
+_STORE_ENTRY_OVERHEAD = 240
+
+
+def estimate_result_size(result):
+    """粗略估算一个解析结果占用的内存字节数（驻留的键元组由所有被试共用，不计入）。"""
+    if isinstance(result, StatsRecords):
+        return sys.getsizeof(result.values) + 64
+    if isinstance(result, MeasureValues):
+        return sys.getsizeof(result.values_) + sum(sys.getsizeof(value) for value in result.values_) + 64
+    if isinstance(result, list):
+        # 'read_aseg_records'的 [(结构名, 体积), ...]
+        return sys.getsizeof(result) + len(result) * 120
+    return sys.getsizeof(result)
+
+
+class StatsStore:
+    """
+    stats文件解析结果的进程内LRU存储，键为文件路径，条目在文件的 (mtime_ns, 大小) 变化后失效。
+    'max_bytes'是估算的内存上限，超过时按最近最少使用的顺序淘汰；所有方法都是线程安全的。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_STORE_BYTES, enabled=True):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.entries = OrderedDict()  # {路径: (签名, 解析结果, 估算字节数)}，按最近使用的顺序排列
+        self.signatures = {}  # {路径: 'get'时读取到的签名}，供'put'使用
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def enable(self, max_bytes=None):
+        """开启存储；'max_bytes'提供时同时调整内存上限。"""
+        with self.lock:
+            self.enabled = True
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+                self._evict()
+
+    def disable(self):
+        """关闭存储并释放所有条目。"""
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        """清空所有条目和计数。"""
+        with self.lock:
+            self.entries.clear()
+            self.signatures.clear()
+            self.total_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, path):
+        """查询文件的解析结果，返回 (是否命中, 解析结果)；文件已变化的条目被删除并视为未命中。"""
+        signature = self._signature(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self.entries[path]
+                self.total_bytes -= entry[2]
+            self.signatures[path] = signature
+            self.misses += 1
+            return False, None
+
+    def put(self, path, result):
+        """保存一个文件的解析结果，签名使用'get'时读取到的值（解析期间文件发生的变化下次会被发现）。"""
+        with self.lock:
+            signature = self.signatures.pop(path, None)
+        if signature is None:
+            signature = self._signature(path)
+        size = estimate_result_size(result) + _STORE_ENTRY_OVERHEAD + sys.getsizeof(path)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+            self.entries[path] = (signature, result, size)
+            self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未使用的条目，直到估算的总内存不超过上限（调用方持有锁）。"""
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def info(self):
+        """返回条目数、估算内存和命中、未命中、淘汰的计数。"""
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# 所有库函数共用的进程内存储，默认关闭
+STATS_STORE = StatsStore(enabled=False)
+
+
+# --- 原子写出 ---
+#
+# 输出文件先完整写入同一文件夹中的临时文件，刷新并fsync后再用'os.replace'原子地替换目标文件。
+# 运行中途崩溃或被中断时，目标文件要么是上一次的完整结果，要么是本次的完整结果，
+# 下游任务不会读到写了一半的文件。
+#
+
+def atomic_write(output_path, mode='w', checksum=False):
+    """
+    返回一个上下文管理器，产出同一文件夹中临时文件的文件对象（文本模式时newline=''，供csv模块使用）；
+    正常结束时fsync并原子替换'output_path'，发生异常时删除临时文件，目标文件保持不变。
+    'checksum'为True时，替换后再写出'<输出文件>.sha256'校验文件（与'sha256sum'的格式相同）。
+    """
+    return _atomic_write(output_path, mode, checksum)
+
+
+def _read_umask():
+    """
+    读取进程的umask。优先从'/proc/self/status'读取，不修改umask；
+    没有该文件的系统上只能先设置再恢复，因此只在导入时调用一次，不在多线程写出的过程中修改进程级的umask。
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):
+        pass
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# 导入时读取一次的umask，用于确定新建输出文件的权限
+_UMASK = _read_umask()
+
+
+def _output_permissions(output_path):
+    """
+    mkstemp 创建的文件只有所有者可读写，
+    这里返回与普通新建文件（或被替换的文件）相同的权限。
+    """
+    try:
+        return os.stat(output_path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+
+@contextlib.contextmanager
+def _atomic_write(output_path, mode, checksum):
+    directory = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(output_path)}.', suffix='.tmp')
+    try:
+        os.chmod(temp_path, _output_permissions(output_path))
+        with open(fd, mode, **({} if 'b' in mode else {'newline': ''})) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, output_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_path)
+        raise
+    _fsync_directory(directory)
+    if checksum:
+        write_checksum(output_path)
+
+
+@contextlib.contextmanager
+def atomic_path(output_path, checksum=False):
+    """
+    与'atomic_write'相同，但产出临时文件的路径，供需要自己打开文件的写出方（例如SQLite）使用。
+    写出方必须在上下文结束前关闭文件；之后这里fsync临时文件并原子替换'output_path'。
+    """
+    directory = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(output_path)}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        os.chmod(temp_path, _output_permissions(output_path))
+        yield temp_path
+        fd = os.open(temp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_path)
+        raise
+    _fsync_directory(directory)
+    if checksum:
+        write_checksum(output_path)
+
+
+def _fsync_directory(directory):
+    """fsync文件夹，使重命名本身也落盘；不支持的平台（如Windows）上忽略。"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_checksum(output_path):
+    """计算输出文件的SHA-256，原子地写出'<输出文件>.sha256'，返回十六进制摘要。"""
+    digest = hashlib.sha256()
+    with open(output_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    with atomic_write(output_path + '.sha256') as file:
+        file.write(f'{digest.hexdigest()}  {os.path.basename(output_path)}\n')
+    return digest.hexdigest()
+
+
+# --- 被试登记表 ---
+#
+# 以前被试ID有两种推导方式：aseg 用'get_parent_folder_name(path, levels_up=3)'，
+# brainvol 和其他表格用'os.path.basename(os.path.dirname(stats_dir))'，再按字符串ID逐行连接各列。
+# 两者不一致时（例如纵向的'.long.'文件夹或按站点嵌套的文件夹），brainvol 列会静默地变成'N/A'。
+# 现在在解析完成后只构建一次被试登记表：
+# 1. 用同一个可配置的规则（文件夹名、BIDS风格的'sub-*/ses-*'或正则表达式）解析每个stats文件夹的被试ID；
+# 2. 为每个被试分配稳定的整数行号，并记录它对应的stats文件夹；
+# 3. 各列（aseg、brainvol、其他表格）都按第i个解析结果所属的行号直接写入数组，不再按字符串逐列查找。
+# 无法按规则解析出被试ID的文件夹会被跳过并打印提示，而不是静默地产生缺失值。
+#
+
+# BIDS 风格的被试和会话标签，不能紧跟在字母或数字之后
+_BIDS_SUBJECT = re.compile(r'(?<![A-Za-z0-9])sub-[A-Za-z0-9]+')
+_BIDS_SESSION = re.compile(r'(?<![A-Za-z0-9])ses-[A-Za-z0-9]+')
+
+
+def folder_subject_id(stats_dir):
+    """默认的被试ID：stats文件夹的上一级文件夹名，即'<被试>/stats'中的'<被试>'。"""
+    return get_parent_folder_name(os.path.join(stats_dir, 'aseg.stats'), levels_up=3)
+
+
+def bids_subject_id(stats_dir):
+    """
+    BIDS风格的被试ID：取stats文件夹路径中最后一个'sub-<标签>'和最后一个'ses-<标签>'。
+    例如'sub-01/ses-02/stats'、'sub-01_ses-02/stats'和纵向的'sub-01_ses-02.long.sub-01/stats'
+    都解析为'sub-01_ses-02'；没有会话时为'sub-01'，路径中没有'sub-'时为None。
+    """
+    path = os.path.dirname(os.path.normpath(stats_dir)).replace(os.sep, '/')
+    subjects = _BIDS_SUBJECT.findall(path)
+    if not subjects:
+        return None
+    sessions = _BIDS_SESSION.findall(path)
+    return f'{subjects[-1]}_{sessions[-1]}' if sessions else subjects[-1]
+
+
+# 命令行'--subject-id-pattern'的说明
+SUBJECT_ID_PATTERN_HELP = ("被试ID的解析规则：folder（默认，stats 的上一级文件夹名）、bids（路径中的 sub-*/ses-* 标签）"
+                           "或正则表达式（在 stats 文件夹路径中查找，取名为 subject 的分组或第一个分组）")
+
+
+def subject_id_resolver(pattern=None):
+    """
+    返回把stats文件夹路径解析为被试ID的函数，无法解析时该函数返回None。
+    'pattern'为None或'folder'时使用文件夹名，为'bids'时使用BIDS风格的标签，
+    为可调用对象时直接使用（例如纵向模式的 {stats文件夹: (被试, 会话)}.get），
+    否则作为正则表达式在stats文件夹路径（以'/'分隔）中查找：
+    取名为'subject'的分组，没有时取第一个分组，再没有时取整个匹配。
+    正则表达式无效时抛出're.error'。
+    """
+    if callable(pattern):
+        return pattern
+    if pattern is None or pattern == 'folder':
+        return folder_subject_id
+    if pattern == 'bids':
+        return bids_subject_id
+    regex = re.compile(pattern)
+    group = 'subject' if 'subject' in regex.groupindex else (1 if regex.groups else 0)
+
+    def resolve(stats_dir):
+        match = regex.search(os.path.normpath(stats_dir).replace(os.sep, '/'))
+        return match.group(group) if match else None
+    return resolve
+
+
+class SubjectRegistry:
+    """
+    被试登记表：由'collect_subject_stats'的结果构建一次，把每个被试映射为整数行号和它的stats文件夹。
+    只有含 aseg 记录的被试才有输出行（与'main'一致），行号按首次出现的顺序分配；
+    'entry_rows[i]'是第i个解析结果所属的行号，-1表示该结果不输出。
+    'id_pattern'是被试ID的解析规则（见'subject_id_resolver'）。
+    """
+
+    def __init__(self, subject_stats, id_pattern=None):
+        resolve_id = subject_id_resolver(id_pattern)
+        self.subject_ids = []  # 行号 -> 被试ID
+        self.index = {}  # 被试ID -> 行号
+        self.stats_dirs = []  # 行号 -> [stats文件夹, ...]
+        self.unresolved = []  # 无法解析出被试ID的stats文件夹
+        entry_ids = []
+        for stats_dir, aseg_records, _, _ in subject_stats:
+            subject_id = resolve_id(stats_dir)
+            entry_ids.append(subject_id)
+            if subject_id is None:
+                self.unresolved.append(stats_dir)
+            elif aseg_records is not None and subject_id not in self.index:
+                self.index[subject_id] = len(self.subject_ids)
+                self.subject_ids.append(subject_id)
+                self.stats_dirs.append([])
+
+        # 第二遍：每个解析结果（包括只有 brainvol 或其他表格的文件夹）按被试ID找到所属的行
+        self.entry_rows = np.full(len(entry_ids), -1, dtype=np.intp)
+        for i, (subject_id, entry) in enumerate(zip(entry_ids, subject_stats)):
+            row = self.index.get(subject_id, -1)
+            if row >= 0:
+                self.entry_rows[i] = row
+                self.stats_dirs[row].append(entry[0])
+
+    def __len__(self):
+        return len(self.subject_ids)
+
+
+def report_unresolved(stats_dirs, limit=5):
+    """打印无法按规则解析出被试ID、因此被跳过的stats文件夹，最多列出'limit'个。"""
+    if stats_dirs:
+        more = '等' if len(stats_dirs) > limit else ''
+        print(f"有 {len(stats_dirs)} 个 stats 文件夹无法按被试ID规则解析，已跳过: {'、'.join(stats_dirs[:limit])}{more}")
+
+
+# --- 主逻辑函数 ---
+
+def main(current_folder, jobs=1, subject_stats=None, keep_intermediate=False):
+    """
+    这是脚本的核心执行函数。
+    它协调整个流程：解析.stats文件，聚合数据，最后生成转置后的汇总CSV表。
+    'subject_stats'是'collect_subject_stats'的结果，不传入时会在这里重新遍历解析。
+    """
+    # 1. 直接解析所有'aseg.stats'文件中的体积数据
+    if subject_stats is None:
+        subject_stats = collect_subject_stats(current_folder, ('aseg.stats',), jobs, keep_intermediate)
+
+    # 2. 构建 被试×结构 的体积矩阵
+    with PROFILER.stage('aggregation'):
+        matrix, subject_index, structure_index = build_aseg_matrix(subject_stats)
+
+    # 3. 直接写出最终格式（行为被试，列为大脑结构），只写一次
+    output_path = os.path.join(current_folder, 'total.csv')  # 定义最终输出文件的完整路径
+    with PROFILER.stage('writing'):
+        write_matrix_csv(output_path, matrix, list(subject_index), list(structure_index))
+
+
+def build_aseg_matrix(subject_stats, structures=None, registry=None):
+    """
+    把'collect_subject_stats'的结果聚合为一个 被试×结构 的float64矩阵。
+    返回 (矩阵, {被试ID: 行号}, {结构名: 列号})，两个字典的顺序即首次出现的顺序。
+    'structures'是所选的结构列表，提供时列固定为这些结构（按给出的顺序），其余结构被忽略。
+    'registry'是'SubjectRegistry'，行号由它决定；不传入时按文件夹名构建。
+    某个被试缺少某个结构时，对应位置为NaN。
+    """
+    if registry is None:
+        registry = SubjectRegistry(subject_stats)
+
+    # 1. 第一遍：按遍历顺序为结构分配列号，行号直接取自登记表
+    structure_index = {}  # {结构名: 列号}
+    if structures is not None:
+        structure_index = {struct_name: i for i, struct_name in enumerate(dict.fromkeys(structures))}
+    layout_columns = {}  # {id(驻留的结构名元组): (行内位置或None, 列号数组)}，相同布局的被试只计算一次
+    subject_rows = []  # [(行号, 行内位置, 列号数组, 记录), ...]，供第二遍填充
+    for row, (_, aseg_records, _, _) in zip(registry.entry_rows.tolist(), subject_stats):
+        # 同名被试共用同一行
+        if aseg_records is None or row < 0:
+            continue
+        layout = layout_columns.get(id(aseg_records.keys))
+        if layout is None:
+            if structures is None:
+                layout = (None, np.array([structure_index.setdefault(struct_name, len(structure_index))
+                                          for struct_name in aseg_records.keys], dtype=np.intp))
+            else:
+                # 列固定时只取所选的结构（解析时未下推选择的记录，例如来自缓存，也可能含有其他结构）
+                positions = [i for i, struct_name in enumerate(aseg_records.keys) if struct_name in structure_index]
+                layout = (np.array(positions, dtype=np.intp),
+                          np.array([structure_index[aseg_records.keys[i]] for i in positions], dtype=np.intp))
+            layout_columns[id(aseg_records.keys)] = layout
+        subject_rows.append((row,) + layout + (aseg_records,))
+
+    # 2. 第二遍：一次性分配矩阵并逐被试填充，后出现的同名被试覆盖先出现的
+    matrix = np.full((len(registry), len(structure_index)), np.nan, dtype=np.float64)
+    for row, positions, columns, aseg_records in subject_rows:
+        # 直接引用 array('d') 的缓冲区，不再逐个转换数值
+        values = np.frombuffer(aseg_records.values, dtype=np.float64)
+        matrix[row, columns] = values if positions is None else values[positions]
+
+    return matrix, registry.index, structure_index
+
+
+def report_missing_structures(matrix, structure_index):
+    """打印在所有被试中都没有数值的所选结构（例如结构名拼写错误）。"""
+    missing = [struct_name for struct_name, column in structure_index.items() if np.isnan(matrix[:, column]).all()]
+    if missing and len(matrix):
+        print(f"所选结构在所有被试中都没有数值，输出为空列: {', '.join(missing)}")
+
+
+def write_matrix_csv(output_path, matrix, subject_ids, structure_names):
+    """
+    把 被试×结构 矩阵写为CSV：表头第一格留空，其余是结构名；
+    每行第一列是被试ID，其余是体积，NaN写为空。
+    """
+    with atomic_write(output_path) as file:
+        writer = csv.writer(file)
+        writer.writerow([''] + structure_names)
+        # tolist() 一次性转换为Python浮点数，避免逐个访问numpy标量
+        for subject_id, values in zip(subject_ids, matrix.tolist()):
+            # NaN 不等于自身，写为空单元格
+            writer.writerow([subject_id] + ['' if value != value else repr(value) for value in values])
+    PROFILER.count('rows_written', len(subject_ids) + 1)
+
+
+# --- 从 brainvol.stats 文件提取并追加数据的函数 ---
+#
+# 旧版本中每个指标都有一个独立的'process_*'函数，各自完整遍历一次文件夹、
+# 重新打开每个'brainvol.stats'，并把'total.csv'整体重写一次（16个指标即16次）。
+# 现在改为表驱动：
+# 1. 只遍历一次文件夹结构，寻找'brainvol.stats'文件。
+# 2. 每个文件只打开一次，把所有'# Measure'行解析为 {度量键: 数值} 字典。
+# 3. 按下面的'BRAINVOL_MEASURES'表，为每个被试一次性取出所有指标。
+# 4. 读取现有的'total.csv'，追加全部指标列后只写回一次。
+#
+# 原有的'process_*'函数保留为薄封装，方便作为库单独调用。
+#
+
+# 需要追加到汇总表的指标：(输出列名, 'brainvol.stats'中'# Measure'行的度量键)
+# 列表顺序即输出列的顺序
+BRAINVOL_MEASURES = [
+    ('Brain Segmentation Volume', 'BrainSeg'),
+    ('Brain Segmentation Volume Without Ventricles', 'BrainSegNotVent'),
+    ('SupratentorialVol', 'SupraTentorial'),
+    ('SupraTentorialVolNotVent', 'SupraTentorialNotVent'),
+    ('SubCortGrayVol', 'SubCortGray'),
+    ('lhCortexVol', 'lhCortex'),
+    ('rhCortexVol', 'rhCortex'),
+    ('CortexVol', 'Cortex'),
+    ('TotalGrayVol', 'TotalGray'),
+    ('lhCerebralWhiteMatterVol', 'lhCerebralWhiteMatter'),
+    ('rhCerebralWhiteMatterVol', 'rhCerebralWhiteMatter'),
+    ('CerebralWhiteMatterVol', 'CerebralWhiteMatter'),
+    ('MaskVol', 'Mask'),
+    ('SupraTentorialVolNotVentVox', 'SupraTentorialNotVentVox'),
+    ('BrainSegVolNotVentSurf', 'BrainSegNotVentSurf'),
+    ('VentricleChoroidVol', 'VentricleChoroidVol'),
+]
+
+
+def parse_brainvol_measures(stats_file_path, content=None, keys=None):
+    """
+    读取一个'brainvol.stats'文件，一次性解析出其中所有的'# Measure'行。
+    返回紧凑的只读字典 {度量键: 数值字符串}，例如 {'BrainSeg': '1243340.000000', ...}。
+    'content'是已经预读取的文件内容（bytes），传入时不再打开文件。
+    'keys'是需要的度量键集合，提供时只保留这些度量键。
+    """
+    measures, _ = parse_stats_table(stats_file_path, content=content)
+    if keys is not None:
+        measures = {key: value for key, value in measures.items() if key in keys}
+    return MeasureValues.from_dict(measures)
+
+
+def note_missing_measures(missing, subject_id, values, measures):
+    """
+    记录一个被试缺少的指标，'values'是该被试的 {度量键: 数值}，没有'brainvol.stats'时为None。
+    'missing'形如 {度量键: [被试ID, ...]}，缺少整个文件的被试记在键None下。
+    没有选择任何指标时不需要'brainvol.stats'，不记录缺失。
+    """
+    if not measures:
+        return
+    if values is None:
+        missing.setdefault(None, []).append(subject_id)
+        return
+    for _, key in measures:
+        if key not in values:
+            missing.setdefault(key, []).append(subject_id)
+
+
+def report_missing_measures(missing, measures, limit=5):
+    """按'note_missing_measures'的记录打印缺失的指标，每项最多列出'limit'个被试ID。"""
+    def examples(subject_ids):
+        more = '等' if len(subject_ids) > limit else ''
+        # 纵向模式的被试ID是 (被试, 会话) 元组，显示为'被试/会话'
+        return '、'.join(subject_id if isinstance(subject_id, str) else '/'.join(subject_id)
+                        for subject_id in subject_ids[:limit]) + more
+
+    if None in missing:
+        subject_ids = missing[None]
+        print(f"有 {len(subject_ids)} 个被试找不到 brainvol.stats，其所有指标记为缺失: {examples(subject_ids)}")
+    for column, key in measures:
+        if key in missing:
+            subject_ids = missing[key]
+            print(f"有 {len(subject_ids)} 个被试的 brainvol.stats 中缺少度量键 '{key}'（列 '{column}'），"
+                  f"记为缺失: {examples(subject_ids)}")
+
+
+def merge_brainvol_measures(subject_stats):
+    """
+    按文件夹名合并'collect_subject_stats'结果中的 brainvol 指标，返回 {文件夹名: {度量键: 数值}}。
+    同名文件夹出现多次时，后出现的值覆盖先出现的值（与旧版逐指标覆盖的行为一致）。
+    """
+    results = {}
+    for stats_dir, _, brainvol_measures, _ in subject_stats:
+        if brainvol_measures is not None:
+            results.setdefault(folder_subject_id(stats_dir), {}).update(brainvol_measures)
+    return results
+
+
+def build_brainvol_values(subject_stats, registry, keys):
+    """
+    按登记表的行号把 brainvol 指标整理为 被试×度量键 的数组，单元格是原始的数值字符串，缺失为None。
+    同一行的多个'brainvol.stats'中，后出现的值覆盖先出现的值。
+    返回 (数值数组, 每行是否有'brainvol.stats'的布尔数组)。
+    """
+    values = np.full((len(registry), len(keys)), None, dtype=object)
+    has_file = np.zeros(len(registry), dtype=bool)
+    for row, (_, _, brainvol_measures, _) in zip(registry.entry_rows.tolist(), subject_stats):
+        if brainvol_measures is None or row < 0:
+            continue
+        has_file[row] = True
+        for column, key in enumerate(keys):
+            value = brainvol_measures.get(key)
+            if value is not None:
+                values[row, column] = value
+    return values, has_file
+
+
+def collect_missing_measures(subject_ids, values, has_file, measures):
+    """由'build_brainvol_values'的结果收集缺失的指标，格式与'note_missing_measures'相同。"""
+    missing = {}
+    if not measures:
+        return missing
+    rows_without_file = np.flatnonzero(~has_file).tolist()
+    if rows_without_file:
+        missing[None] = [subject_ids[row] for row in rows_without_file]
+    rows_with_file = np.flatnonzero(has_file).tolist()
+    for column, (_, key) in enumerate(measures):
+        rows = [row for row in rows_with_file if values[row, column] is None]
+        if rows:
+            missing[key] = [subject_ids[row] for row in rows]
+    return missing
+
+
+def process_brainvol_measures(root_dir, output_file, measures=BRAINVOL_MEASURES, jobs=1, subject_stats=None):
+    """
+    只遍历一次文件夹，解析每个'brainvol.stats'一次，
+    然后把'measures'表中的所有指标作为新列一次性追加到汇总文件。
+    'subject_stats'是'collect_subject_stats'的结果，不传入时会在这里重新遍历解析。
+    """
+    # 1. 遍历并解析，results 形如 {文件夹名: {度量键: 数值}}
+    if subject_stats is None:
+        subject_stats = collect_subject_stats(root_dir, ('brainvol.stats',), jobs)
+    results = merge_brainvol_measures(subject_stats)
+
+    # 2. 读取现有CSV数据
+    with open(output_file, 'r', newline='') as csvfile:
+        csvreader = csv.reader(csvfile)
+        headers = next(csvreader)  # 读取表头
+        rows = list(csvreader)
+
+    # 3. 写入新数据，一次性增加所有指标列
+    missing = {}
+    with atomic_write(output_file) as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(headers + [column for column, _ in measures])  # 写入新表头
+        for row in rows:
+            values = results.get(row[0])  # 第一列是被试ID
+            note_missing_measures(missing, row[0], values, measures)
+            # 按度量键直接查找每个指标，找不到则填'N/A'（缺失情况在下面统一报告）
+            values = values or {}
+            row.extend(values.get(key, 'N/A') for _, key in measures)
+            csvwriter.writerow(row)
+    PROFILER.count('rows_written', len(rows) + 1)
+    report_missing_measures(missing, measures)
+
+
+def _measure(column):
+    """按输出列名在'BRAINVOL_MEASURES'表中查找对应的单项 (列名, 度量键)。"""
+    return [item for item in BRAINVOL_MEASURES if item[0] == column]
+
+
+# 下面的函数只追加单个指标，保留它们是为了兼容旧的调用方式。
+# 需要多个指标时请直接调用 `process_brainvol_measures`，避免重复遍历和重写。
+
+def process_brain_segmentation_volume(root_dir, output_file):
+    """从'brainvol.stats'提取'Brain Segmentation Volume'并追加到汇总文件。"""
+    process_brainvol_measures(root_dir, output_file, _measure('Brain Segmentation Volume'))
+
+
+def process_Brain_Segmentation_Volume_Without_Ventricles(root_dir, output_file):
+    """提取'Brain Segmentation Volume Without Ventricles'并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('Brain Segmentation Volume Without Ventricles'))
+
+
+def process_SupratentorialVol(root_dir, output_file):
+    """提取'SupratentorialVol' (幕上体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('SupratentorialVol'))
+
+
+def process_SupraTentorialVolNotVent(root_dir, output_file):
+    """提取'SupraTentorialVolNotVent' (不含脑室的幕上体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('SupraTentorialVolNotVent'))
+
+
+def process_SubCortGrayVol(root_dir, output_file):
+    """提取'SubCortGrayVol' (皮层下灰质体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('SubCortGrayVol'))
+
+
+def process_lhCortexVol(root_dir, output_file):
+    """提取'lhCortexVol' (左半球皮层灰质体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('lhCortexVol'))
+
+
+def process_rhCortexVol(root_dir, output_file):
+    """提取'rhCortexVol' (右半球皮层灰质体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('rhCortexVol'))
+
+
+def process_TotalGrayVol(root_dir, output_file):
+    """提取'TotalGrayVol' (总灰质体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('TotalGrayVol'))
+
+
+def process_CortexVol(root_dir, output_file):
+    """提取'CortexVol' (总皮层灰质体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('CortexVol'))
+
+
+def process_lhCerebralWhiteMatterVol(root_dir, output_file):
+    """提取'lhCerebralWhiteMatterVol' (左半球大脑白质体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('lhCerebralWhiteMatterVol'))
+
+
+def process_rhCerebralWhiteMatterVol(root_dir, output_file):
+    """提取'rhCerebralWhiteMatterVol' (右半球大脑白质体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('rhCerebralWhiteMatterVol'))
+
+
+def process_CerebralWhiteMatterVol(root_dir, output_file):
+    """提取'CerebralWhiteMatterVol' (总大脑白质体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('CerebralWhiteMatterVol'))
+
+
+def process_MaskVol(root_dir, output_file):
+    """提取'MaskVol' (Mask 体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('MaskVol'))
+
+
+def process_SupraTentorialVolNotVentVox(root_dir, output_file):
+    """提取'SupraTentorialVolNotVentVox' (幕上体积体素计数) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('SupraTentorialVolNotVentVox'))
+
+
+def process_BrainSegVolNotVentSurf(root_dir, output_file):
+    """提取'BrainSegVolNotVentSurf' (来自表面的不含脑室的脑分割体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('BrainSegVolNotVentSurf'))
+
+
+def process_VentricleChoroidVol(root_dir, output_file):
+    """提取'VentricleChoroidVol' (脑室和脉络丛体积) 并追加。"""
+    process_brainvol_measures(root_dir, output_file, _measure('VentricleChoroidVol'))
+
+
+# --- 选择性提取 ---
+#
+# 日常的看板通常只需要十几个 aseg 结构和三四个 brainvol 指标。
+# 用'--structures'和'--measures'指定所需的列后，选择会下推到解析器：
+# 1. 'aseg.stats'中不需要的结构行在转换浮点数之前就被跳过；
+# 2. 'brainvol.stats'只保留所需的度量键；
+# 3. 不提供任何所需列的文件（例如不需要任何 brainvol 指标时的'brainvol.stats'）不会被打开。
+# 输出的结构列和指标列按用户给出的顺序排列；不提供选项时与完整汇总完全相同。
+#
+
+# 下推给解析器的选择：需要的结构名集合和度量键集合，None表示全部
+StatsSelection = namedtuple('StatsSelection', ['structures', 'measure_keys'], defaults=(None, None))
+
+
+def parse_name_list(text):
+    """解析命令行中的名称列表：逗号分隔，或'@<文件>'（每行一个名称，忽略空行和以'#'开头的行）。"""
+    if text.startswith('@'):
+        return read_name_list(text[1:])
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+
+def resolve_measures(names):
+    """
+    把用户给出的指标名（输出列名或度量键）解析为 [(输出列名, 度量键), ...]，保持给出的顺序。
+    不在'BRAINVOL_MEASURES'中的名称直接作为度量键（'# Measure'行的第一个字段），
+    输出列名与度量键相同（例如'EstimatedTotalIntraCranialVol'）。
+    指向同一个度量键的名称（例如'MaskVol'和'Mask'）只保留第一个。
+    """
+    known = {}
+    for column, key in BRAINVOL_MEASURES:
+        known[column] = known[key] = (column, key)
+    resolved = {}  # {度量键: (输出列名, 度量键)}，用字典去重并保持首次出现的顺序
+    for name in names:
+        column, key = known.get(name, (name, name))
+        resolved.setdefault(key, (column, key))
+    return list(resolved.values())
+
+
+def stats_selection(structures=None, measures=BRAINVOL_MEASURES, derived=None):
+    """
+    由所选的结构列表和指标表构建下推给解析器的'StatsSelection'，不需要选择时返回None。
+    'derived'是'DerivedOptions'，提供时额外保留派生列所需的参考体积。
+    """
+    if structures is None and measures is BRAINVOL_MEASURES:
+        return None
+    measure_keys = {key for _, key in measures}
+    if derived is not None:
+        measure_keys.add(DERIVED_REFERENCES[derived.reference])
+    return StatsSelection(None if structures is None else frozenset(structures), frozenset(measure_keys))
+
+
+def selected_file_patterns(file_names, selection):
+    """去掉不提供任何所需列的文件：不需要任何度量键时不再发现和打开'brainvol.stats'。"""
+    if selection is not None and not selection.measure_keys:
+        return tuple(name for name in file_names if name != 'brainvol.stats')
+    return file_names
+
+
+def skips_file(file_name, selection):
+    """所选结构为空时，'aseg.stats'只用来确定被试行，不需要打开。"""
+    return selection is not None and selection.structures is not None and not selection.structures \
+        and file_name == 'aseg.stats'
+
+
+# --- 其他stats表格的输出列 ---
+
+def build_table_columns(subject_stats, tables, registry=None):
+    """
+    把所请求表格（'STATS_TABLES'中的名称）的记录整理为输出列。
+    列按注册表顺序排列，表内按键首次出现的顺序、再按数值列的顺序。
+    'registry'是'SubjectRegistry'，行号由它决定；不传入时按文件夹名构建。
+    返回 (列名列表, 每列来源文件模式列表, 每列度量键列表, 被试×列 的float64矩阵（缺失为NaN）)。
+    """
+    if registry is None:
+        registry = SubjectRegistry(subject_stats)
+    column_index = {}  # {(表格名, 键, 数值列): 列号}
+    column_names, sources, keys = [], [], []
+    # 先按注册表顺序为每个表格分配列，保证列顺序与被试的遍历顺序无关
+    ordered_tables = [table_name for table_name in STATS_TABLES if table_name in tables]
+    for table_name in ordered_tables:
+        table = STATS_TABLES[table_name]
+        for _, _, _, table_records in subject_stats:
+            for key, _ in table_records.get(table_name, ()):
+                for value_column in table.value_columns:
+                    if (table_name, key, value_column) not in column_index:
+                        column_index[(table_name, key, value_column)] = len(column_names)
+                        column_names.append(f'{table.prefix}{key}_{value_column}')
+                        sources.append(table.pattern)
+                        keys.append(f'{key}:{value_column}')
+
+    # 再按登记表的行号（与 aseg、brainvol 相同）填入数值，同名被试后出现的覆盖先出现的
+    matrix = np.full((len(registry), len(column_names)), np.nan, dtype=np.float64)
+    for row, (_, _, _, table_records) in zip(registry.entry_rows.tolist(), subject_stats):
+        if row < 0:
+            continue
+        for table_name in ordered_tables:
+            value_columns = STATS_TABLES[table_name].value_columns
+            for key, values in table_records.get(table_name, ()):
+                for value_column, value in zip(value_columns, values):
+                    matrix[row, column_index[(table_name, key, value_column)]] = value
+
+    return column_names, sources, keys, matrix
+
+
+# --- 派生指标与质控 ---
+#
+# 汇总之后常用的派生指标直接在内存中的 被试×结构 矩阵上一次性计算，不再重新读取 total.csv：
+# 1. 标准化体积：每个 aseg 结构的体积除以参考体积（Mask 或 eTIV），列名 '<结构>_to_<参考>'；
+# 2. 左右不对称指数：成对的'Left-*'/'Right-*'结构，AI = (L - R) / ((L + R) / 2)，列名 'AI_<结构>'；
+# 3. 稳健z分数离群标记：对标准化体积、不对称指数和 brainvol 指标的每一列，
+#    z = (x - 中位数) / (1.4826 × MAD)，每个被试输出 |z| 超过阈值的列数'qc_outlier_count'
+#    和最大的 |z| 'qc_max_abs_z'。
+# 全部为按列的NumPy向量运算，缺失值（NaN）不参与统计。
+#
+
+# 可用的参考体积：名称 -> brainvol.stats 中'# Measure'行的度量键
+DERIVED_REFERENCES = {'Mask': 'Mask', 'eTIV': 'EstimatedTotalIntraCranialVol'}
+
+DerivedOptions = namedtuple('DerivedOptions', ['reference', 'outlier_threshold'], defaults=('Mask', 3.5))
+
+
+def build_measure_matrix(values):
+    """
+    把'build_brainvol_values'得到的数值字符串数组转换为 被试×度量键 的float64矩阵，
+    缺失或无法转换为数值的值为NaN。
+    """
+    # 先整体转换（缺失记为'nan'），有无法转换的值时再逐个转换
+    shape = values.shape
+    cells = ['nan' if value is None else value for value in values.ravel().tolist()]
+    try:
+        return np.fromiter(map(float, cells), dtype=np.float64, count=len(cells)).reshape(shape)
+    except ValueError:
+        pass
+    measure_matrix = np.full(len(cells), np.nan, dtype=np.float64)
+    for i, value in enumerate(cells):
+        try:
+            measure_matrix[i] = float(value)
+        except ValueError:
+            pass
+    return measure_matrix.reshape(shape)
+
+
+def column_nanmedian(matrix):
+    """
+    按列求忽略NaN的中位数，整列缺失时为NaN。
+    与'np.nanmedian(matrix, axis=0)'结果相同，但只排序一次，不逐列处理。
+    """
+    if len(matrix) == 0:
+        return np.full(matrix.shape[1], np.nan)
+    ordered = np.sort(matrix, axis=0)  # NaN 排在每列末尾
+    counts = np.count_nonzero(~np.isnan(matrix), axis=0)
+    columns = np.arange(matrix.shape[1])
+    # 每列有效值个数为k时，中位数是排序后第 (k-1)//2 和 k//2 个值的平均
+    median = (ordered[np.maximum(counts - 1, 0) // 2, columns] + ordered[counts // 2, columns]) / 2
+    median[counts == 0] = np.nan
+    return median
+
+
+def robust_z_scores(matrix):
+    """按列计算稳健z分数；MAD为0或整列缺失时该列为NaN。"""
+    median = column_nanmedian(matrix)
+    mad = column_nanmedian(np.abs(matrix - median))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (matrix - median) / (1.4826 * mad)
+    scores[:, ~(mad > 0)] = np.nan
+    return scores
+
+
+def compute_derived(volumes, structure_names, brainvol, reference, options=DerivedOptions()):
+    """
+    由 被试×结构 体积矩阵、被试×指标 的 brainvol 矩阵和每个被试的参考体积计算派生列。
+    返回 (派生矩阵, 列名列表, 每列的计算说明列表)，行顺序与输入一致。
+    """
+    reference_name = options.reference
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 1. 标准化体积（参考体积缺失时为NaN）
+        normalised = volumes / reference[:, None]
+        # 2. 左右不对称指数
+        structure_columns = {name: i for i, name in enumerate(structure_names)}
+        pairs = [(name[len('Left-'):], i, structure_columns['Right-' + name[len('Left-'):]])
+                 for name, i in structure_columns.items()
+                 if name.startswith('Left-') and 'Right-' + name[len('Left-'):] in structure_columns]
+        left = volumes[:, [i for _, i, _ in pairs]]
+        right = volumes[:, [j for _, _, j in pairs]]
+        asymmetry = (left - right) / ((left + right) / 2)
+
+    # 3. 稳健z分数离群标记
+    scores = np.abs(robust_z_scores(np.hstack([normalised, asymmetry, brainvol])))
+    outlier_count = np.sum(scores > options.outlier_threshold, axis=1).astype(np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # 全为NaN的行
+        max_abs_z = np.nanmax(scores, axis=1) if scores.shape[1] else np.full(len(scores), np.nan)
+
+    names = ([f'{name}_to_{reference_name}' for name in structure_names]
+             + [f'AI_{name}' for name, _, _ in pairs]
+             + ['qc_outlier_count', 'qc_max_abs_z'])
+    keys = ([f'{name}/{reference_name}' for name in structure_names]
+            + [f'(Left-{name} - Right-{name}) / mean' for name, _, _ in pairs]
+            + [f'|robust z| > {options.outlier_threshold}', 'max |robust z|'])
+    return np.hstack([normalised, asymmetry, outlier_count[:, None], max_abs_z[:, None]]), names, keys
+
+
+def derive_columns(volumes, structure_names, subject_stats, registry, measures=BRAINVOL_MEASURES,
+                   options=DerivedOptions(), brainvol=None):
+    """
+    'compute_derived'的便捷入口：按登记表的行号构建 brainvol 矩阵和参考体积。
+    'brainvol'是已经构建好的 brainvol 矩阵（列与'measures'对应），提供时不再重复转换。
+    """
+    keys = [key for _, key in measures]
+    if brainvol is None:
+        brainvol = build_measure_matrix(build_brainvol_values(subject_stats, registry, keys)[0])
+    reference_key = DERIVED_REFERENCES[options.reference]
+    if reference_key in keys:
+        reference = brainvol[:, keys.index(reference_key)].copy()
+    else:
+        reference = build_measure_matrix(build_brainvol_values(subject_stats, registry, [reference_key])[0])[:, 0]
+    # brainvol.stats 中没有参考体积时（例如较新版本只在 aseg.stats 中写出 eTIV），改用 aseg.stats 文件头中的值
+    if np.isnan(reference).any():
+        fallback = build_aseg_header_values(subject_stats, registry, reference_key)
+        reference = np.where(np.isnan(reference), fallback, reference)
+    report_missing_reference(registry.subject_ids, reference, options.reference)
+    return compute_derived(volumes, structure_names, brainvol, reference, options)
+
+
+def build_aseg_header_values(subject_stats, registry, key):
+    """按登记表的行号返回 aseg.stats 文件头中指标'key'的数值，缺失或无法转换时为NaN。"""
+    values = np.full(len(registry), None, dtype=object)
+    for row, (_, aseg_records, _, _) in zip(registry.entry_rows.tolist(), subject_stats):
+        if row >= 0 and aseg_records is not None and aseg_records.measures is not None:
+            value = aseg_records.measures.get(key)
+            if value is not None:
+                values[row] = value
+    return build_measure_matrix(values[:, None])[:, 0]
+
+
+def report_missing_reference(subject_ids, reference, reference_name, limit=5):
+    """参考体积缺失时打印提示：对应被试的 '*_to_<参考>' 列为空。"""
+    rows = np.flatnonzero(np.isnan(reference)).tolist()
+    if not rows:
+        return
+    if len(rows) == len(subject_ids):
+        print(f"所有被试都缺少参考体积 {reference_name}（brainvol.stats 和 aseg.stats 中都没有），"
+              f"'*_to_{reference_name}' 列全部为空")
+        return
+    examples = '、'.join('/'.join(subject_id) if isinstance(subject_id, tuple) else subject_id
+                        for subject_id in (subject_ids[row] for row in rows[:limit]))
+    more = f" 等 {len(rows)} 个被试" if len(rows) > limit else ''
+    print(f"被试 {examples}{more} 缺少参考体积 {reference_name}，其 '*_to_{reference_name}' 列为空")
+
+
+# --- 纵向（多时间点）汇总 ---
+#
+# 纵向队列中每个被试有3~5个时间点，FreeSurfer 的文件夹命名为：
+#   横断面处理：'<时间点>'，例如'sub01_tp1'、'sub-01_ses-01'；
+#   被试模板：'<模板>'，例如'sub01_base'；
+#   纵向处理：'<时间点>.long.<模板>'，例如'sub01_tp1.long.sub01_base'。
+# 纵向模式把每个stats文件夹解析为 (被试, 会话)：会话是时间点名；
+# 有纵向处理的时间点以模板名为被试（FreeSurfer 明确给出的被试关联），它的横断面文件夹归到同一个模板下；
+# 同一被试中没有纵向结果的其他时间点按推断出的被试名归到该模板下。
+# 完全没有纵向处理的被试才按 BIDS 的'sub-'标签或时间点名中'_ses'、'_tp'等后缀之前的部分推断，
+# 此时被试列中同时有模板名和推断出的名称，会打印提示。
+# 同一个 (被试, 会话) 同时有纵向和横断面结果时只保留纵向结果，被试模板本身不输出。
+# 宽表以 (subject, session) 为索引；'--tidy'额外写出长表，两者由同一次解析的结果构建。
+# 被试登记表直接按 (被试, 会话) 元组分配行号，没有按列表逐个查重的平方复杂度。
+#
+
+# 纵向模式输出的索引列
+SESSION_INDEX = ('subject', 'session')
+
+# 命令行'--longitudinal'和'--tidy'的说明
+LONGITUDINAL_HELP = ("纵向模式：识别 FreeSurfer 的横断面（<时间点>）和纵向（<时间点>.long.<模板>）文件夹，"
+                     "以 (subject, session) 为行，同一时间点优先使用纵向结果，不输出被试模板")
+TIDY_HELP = '额外写出长表 total.long.csv（subject[, session], measure, source, value），与宽表来自同一次解析'
+
+# 时间点名中的会话后缀，例如'sub01_tp1'、'P001-ses-2'、'abc_visit03'
+_SESSION_SUFFIX = re.compile(r'^(?P<subject>.+?)[_-](?:ses|tp|visit|time|wave|v|t)-?[0-9A-Za-z]*[0-9][0-9A-Za-z]*$',
+                             re.IGNORECASE)
+
+
+def infer_session_subject(time_point):
+    """由横断面的时间点名推断被试：BIDS 的最后一个'sub-'标签，或会话后缀之前的部分，都没有时为时间点名本身。"""
+    subjects = _BIDS_SUBJECT.findall(time_point)
+    if subjects:
+        return subjects[-1]
+    match = _SESSION_SUFFIX.match(time_point)
+    return match.group('subject') if match else time_point
+
+
+def resolve_sessions(stats_dirs):
+    """
+    按 FreeSurfer 的纵向命名规则，把每个stats文件夹解析为 (被试, 会话, 类型)，
+    类型为'long'（纵向处理）、'cross'（横断面处理）或'base'（被试模板，会话为None）。
+    有纵向处理的被试以模板名为被试；其余被试由时间点名推断（见'infer_session_subject'）。
+    """
+    folders = [folder_subject_id(stats_dir) for stats_dir in stats_dirs]
+    templates = {}  # {时间点: 模板}
+    aliases = {}  # {推断出的被试: 模板}，让没有纵向结果的时间点也归到同一个模板下
+    for folder in folders:
+        if '.long.' in folder:
+            time_point, template = folder.split('.long.', 1)
+            templates[time_point] = template
+            aliases.setdefault(infer_session_subject(time_point), template)
+    template_names = set(templates.values())
+
+    sessions = []
+    inferred = set()  # 没有纵向处理、由时间点名推断出的被试
+    for folder in folders:
+        if '.long.' in folder:
+            time_point, template = folder.split('.long.', 1)
+            sessions.append((template, time_point, 'long'))
+        elif folder in template_names:
+            sessions.append((folder, None, 'base'))
+        else:
+            subject = templates.get(folder)
+            if subject is None:
+                subject = infer_session_subject(folder)
+                if subject in aliases:
+                    subject = aliases[subject]
+                else:
+                    inferred.add(subject)
+            sessions.append((subject, folder, 'cross'))
+    if template_names and inferred:
+        print(f"纵向模式：{len(template_names)} 个被试以纵向模板名为被试ID，"
+              f"另有 {len(inferred)} 个没有纵向处理的被试，其被试ID由时间点名推断")
+    return sessions
+
+
+def select_sessions(subject_stats):
+    """
+    纵向模式：为每个解析结果确定 (被试, 会话)，去掉被试模板和已有纵向结果的横断面结果，
+    并按 (被试, 会话) 排序，同一被试的各个时间点相邻。
+    返回 (保留的解析结果, {stats文件夹: (被试, 会话)})，后者的'get'可以作为'SubjectRegistry'的被试ID规则。
+    """
+    sessions = resolve_sessions([stats_dir for stats_dir, _, _, _ in subject_stats])
+    longitudinal = {(subject, session) for subject, session, kind in sessions if kind == 'long'}
+    kept = []  # [((被试, 会话), 解析结果), ...]
+    counts = {'long': 0, 'cross': 0, 'base': 0, 'replaced': 0}
+    for entry, (subject, session, kind) in zip(subject_stats, sessions):
+        if kind == 'cross' and (subject, session) in longitudinal:
+            kind = 'replaced'
+        counts[kind] += 1
+        if kind in ('long', 'cross'):
+            kept.append(((subject, session), entry))
+    kept.sort(key=lambda item: item[0])
+    print(f"纵向模式：{counts['long']} 个纵向时间点，{counts['cross']} 个横断面时间点；"
+          f"跳过 {counts['base']} 个被试模板和 {counts['replaced']} 个已有纵向结果的横断面时间点")
+    return [entry for _, entry in kept], {entry[0]: key for key, entry in kept}
+
+
+def write_tidy_csv(output_path, table, checksum=False, longitudinal=False):
+    """
+    把'build_output_table'得到的表写为长表（tidy）CSV，经临时文件原子替换：
+    每个非缺失的数值一行，列为 subject[, session], measure, source, value。
+    """
+    matrix, subject_ids, column_names, sources, _ = table
+    if longitudinal:
+        index_names, index_cells = list(SESSION_INDEX), [list(subject_id) for subject_id in subject_ids]
+    else:
+        index_names, index_cells = ['subject'], [[subject_id] for subject_id in subject_ids]
+    # 一次性找出所有非缺失的单元格（按行优先顺序），不逐个检查NaN
+    rows, columns = np.nonzero(~np.isnan(matrix))
+    with atomic_write(output_path, checksum=checksum) as file:
+        writer = csv.writer(file)
+        writer.writerow(index_names + ['measure', 'source', 'value'])
+        writer.writerows(index_cells[row] + [column_names[column], sources[column], repr(value)]
+                         for row, column, value in zip(rows.tolist(), columns.tolist(),
+                                                       matrix[rows, columns].tolist()))
+    PROFILER.count('tidy_rows_written', len(rows) + 1)
+
+
+# --- 列式输出格式 ---
+#
+# 除了 total.csv，还可以把 被试×指标 的汇总表写为 Parquet / Feather / NPZ：
+# 所有数值都是float64（缺失为NaN），被试ID作为索引，
+# 并为每一列记录其来源的stats文件和度量键，下游可以直接零拷贝加载。
+#
+
+# 支持的输出格式及对应的文件扩展名
+OUTPUT_FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'npz': '.npz',
+    'sqlite': '.sqlite',
+}
+
+
+def build_output_table(subject_stats, measures=BRAINVOL_MEASURES, tables=(), derived=None, structures=None,
+                       id_pattern=None, report=True):
+    """
+    把解析结果整理为完整的 被试×指标 float64 表，列顺序与 total.csv 相同。
+    'tables'是额外输出的注册表格名称；'derived'是'DerivedOptions'，提供时在最后追加派生列。
+    'structures'是所选的结构列表，提供时只输出这些结构列；'id_pattern'是被试ID的解析规则。
+    'report'为False时不打印缺失提示（同一份结果已经由其他输出报告过时使用）。
+    返回 (矩阵, 被试ID列表, 列名列表, 每列来源文件列表, 每列度量键列表)。
+    """
+    registry = SubjectRegistry(subject_stats, id_pattern)
+    if report:
+        report_unresolved(registry.unresolved)
+    matrix, _, structure_index = build_aseg_matrix(subject_stats, structures, registry)
+    if structures is not None and report:
+        report_missing_structures(matrix, structure_index)
+
+    # brainvol 指标列：无法转换为数值的值（包括缺失）记为NaN
+    brainvol_values, has_brainvol = build_brainvol_values(subject_stats, registry, [key for _, key in measures])
+    brainvol_matrix = build_measure_matrix(brainvol_values)
+    if report:
+        report_missing_measures(collect_missing_measures(registry.subject_ids, brainvol_values, has_brainvol,
+                                                         measures), measures)
+
+    # 其他表格的列
+    table_names, table_sources, table_keys, table_matrix = build_table_columns(subject_stats, tables, registry)
+
+    structure_names = list(structure_index)
+    derived_matrix, derived_names, derived_keys = np.empty((len(registry), 0)), [], []
+    if derived is not None:
+        derived_matrix, derived_names, derived_keys = derive_columns(matrix, structure_names, subject_stats, registry,
+                                                                     measures, derived, brainvol_matrix)
+    return (np.hstack([matrix, brainvol_matrix, table_matrix, derived_matrix]),
+            list(registry.subject_ids),
+            structure_names + [column for column, _ in measures] + table_names + derived_names,
+            ['aseg.stats'] * len(structure_names) + ['brainvol.stats'] * len(measures) + table_sources
+            + ['derived'] * len(derived_names),
+            structure_names + [key for _, key in measures] + table_keys + derived_keys)
+
+
+def write_columnar(output_path, output_format, table, checksum=False, longitudinal=False):
+    """
+    把'build_output_table'得到的表写为列式格式（'parquet'、'feather'、'npz'或'sqlite'），经临时文件原子替换。
+    Parquet 和 Feather 需要安装 pyarrow，每列的来源文件和度量键写入字段元数据。
+    'longitudinal'为True时被试ID是 (被试, 会话) 元组，写为 (subject, session) 两级索引。
+    """
+    matrix, subject_ids, column_names, sources, keys = table
+
+    if output_format == 'sqlite':
+        write_sqlite(output_path, table, checksum, longitudinal)
+        return
+
+    if output_format == 'npz':
+        # NPZ：数值矩阵和各个标签数组分别保存，纵向模式额外保存会话数组
+        labels = {'subjects': np.array(subject_ids, dtype=str)}
+        if longitudinal:
+            labels = {'subjects': np.array([subject for subject, _ in subject_ids], dtype=str),
+                      'sessions': np.array([session for _, session in subject_ids], dtype=str)}
+        with atomic_write(output_path, 'wb', checksum) as file:
+            np.savez(file, values=matrix, columns=np.array(column_names, dtype=str),
+                     sources=np.array(sources, dtype=str), keys=np.array(keys, dtype=str), **labels)
+        return
+
+    try:
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError(f"写出 {output_format} 格式需要安装 pyarrow") from error
+
+    # 被试ID作为索引列'subject'（纵向模式为'subject'和'session'两级），pandas 读取时会自动还原为索引
+    index = (pd.MultiIndex.from_tuples(subject_ids, names=list(SESSION_INDEX)) if longitudinal
+             else pd.Index(subject_ids, name='subject'))
+    df = pd.DataFrame(matrix, index=index, columns=column_names)
+    arrow_table = pa.Table.from_pandas(df, preserve_index=True)
+    column_metadata = {name: {'source': source, 'key': key}
+                       for name, source, key in zip(column_names, sources, keys)}
+    fields = [field.with_metadata(column_metadata[field.name]) if field.name in column_metadata else field
+              for field in arrow_table.schema]
+    arrow_table = pa.Table.from_arrays(arrow_table.columns,
+                                       schema=pa.schema(fields, metadata=arrow_table.schema.metadata))
+
+    with atomic_write(output_path, 'wb', checksum) as file:
+        if output_format == 'parquet':
+            pyarrow.parquet.write_table(arrow_table, file)
+        else:
+            pyarrow.feather.write_feather(arrow_table, file)
+
+
+# --- SQLite 导出 ---
+#
+# 把汇总结果直接写入一个本地SQLite数据库文件，供数据仓库加载（DuckDB 也可以通过 sqlite 扩展直接读取）：
+#   total          宽表：每个被试一行（纵向模式为每个 (被试, 会话) 一行），每个指标一列，类型为REAL；
+#   measurements   长表：(subject[, session], measure, value REAL)，每个非缺失的数值一行；
+#   measures       每个指标的来源文件和度量键。
+# 缺失值写为NULL，不再有'N/A'字符串和空单元格，加载时不需要文本解析和类型转换。
+# 所有插入在同一个事务中分批用'executemany'完成，索引在插入之后一次性建立；
+# 数据库先写入同一文件夹中的临时文件，完成后原子替换。
+#
+
+# 每批插入的行数
+SQLITE_BATCH_ROWS = 10000
+# SQLite 默认允许的最大列数（SQLITE_MAX_COLUMN），宽表超过时只写长表
+SQLITE_MAX_COLUMNS = 2000
+
+
+def _quote_identifier(name):
+    """把列名转换为SQLite带引号的标识符。"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _executemany_batches(connection, sql, rows, batch_rows=SQLITE_BATCH_ROWS):
+    """按'batch_rows'行一批执行'executemany'，避免一次性在内存中展开所有行。"""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_rows))
+        if not batch:
+            return
+        connection.executemany(sql, batch)
+
+
+def write_sqlite(output_path, table, checksum=False, longitudinal=False):
+    """
+    把'build_output_table'得到的表写为SQLite数据库（宽表'total'、长表'measurements'和指标说明表'measures'）。
+    'longitudinal'为True时被试ID是 (被试, 会话) 元组，两张表都以 subject、session 两列作为索引。
+    """
+    matrix, subject_ids, column_names, sources, keys = table
+    index_names = list(SESSION_INDEX) if longitudinal else ['subject']
+    index_cells = [tuple(subject_id) for subject_id in subject_ids] if longitudinal else [(subject_id,)
+                                                                                         for subject_id in subject_ids]
+    index_columns = ', '.join(index_names)
+
+    with atomic_path(output_path, checksum) as temp_path:
+        connection = sqlite3.connect(temp_path, isolation_level=None)
+        try:
+            # 临时文件完成后才会替换目标文件，不需要回滚日志；fsync 由'atomic_path'统一完成
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('BEGIN')
+
+            connection.execute('CREATE TABLE measures (measure TEXT PRIMARY KEY, source TEXT, key TEXT)')
+            connection.executemany('INSERT INTO measures VALUES (?, ?, ?)', zip(column_names, sources, keys))
+
+            # 1. 宽表：NaN写为NULL
+            if len(index_names) + len(column_names) <= SQLITE_MAX_COLUMNS:
+                connection.execute(
+                    'CREATE TABLE total ('
+                    + ', '.join([f'{name} TEXT NOT NULL' for name in index_names]
+                                + [f'{_quote_identifier(name)} REAL' for name in column_names]
+                                + [f'PRIMARY KEY ({index_columns})'])
+                    + ')')
+                placeholders = ', '.join('?' * (len(index_names) + len(column_names)))
+                _executemany_batches(connection, f'INSERT INTO total VALUES ({placeholders})',
+                                     (cells + tuple(None if value != value else value for value in values)
+                                      for cells, values in zip(index_cells, matrix.tolist())))
+            else:
+                print(f"共有 {len(column_names)} 列，超过 SQLite 的列数上限，只写出长表 measurements")
+
+            # 2. 长表：每个非缺失的数值一行
+            connection.execute(
+                'CREATE TABLE measurements ('
+                + ', '.join([f'{name} TEXT NOT NULL' for name in index_names]
+                            + ['measure TEXT NOT NULL', 'value REAL NOT NULL'])
+                + ')')
+            rows, columns = np.nonzero(~np.isnan(matrix))
+            _executemany_batches(connection,
+                                 f'INSERT INTO measurements VALUES ({", ".join("?" * (len(index_names) + 2))})',
+                                 (index_cells[row] + (column_names[column], value)
+                                  for row, column, value in zip(rows.tolist(), columns.tolist(),
+                                                                matrix[rows, columns].tolist())))
+            # 插入完成后再建立索引，比边插入边维护索引快
+            connection.execute(f'CREATE INDEX measurements_subject ON measurements ({index_columns})')
+            connection.execute('CREATE INDEX measurements_measure ON measurements (measure)')
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+
+def merge_all(current_folder, jobs=1, keep_intermediate=False, use_cache=False, cache_hash=False,
+              output_format='csv', subjects=None, tables=(), io_threads=0, checksum=False, derived=None,
+              structures=None, measures=BRAINVOL_MEASURES, id_pattern=None, longitudinal=False, tidy=False):
+    """
+    完整的汇总流程：只遍历一次文件夹并解析所有stats文件（'jobs' > 1 时并行），
+    然后在内存中组装 aseg 结构体积、brainvol 指标和表格列（见'write_total_csv'），只写一次 total.csv。
+    'keep_intermediate'为True时保留每个被试的'aseg.stats.csv'中间文件。
+    'use_cache'为True时使用'total.csv'旁边的增量缓存，只解析新增或变化的文件；
+    'cache_hash'为True时缓存额外比较文件内容哈希。
+    'output_format'不是'csv'时，改为写出对应格式的 total.parquet / total.feather / total.npz / total.sqlite。
+    'subjects'是被试文件夹列表，提供时只处理这些被试，不遍历根目录。
+    'tables'是额外提取的表格（'STATS_TABLES'中的名称），与 aseg/brainvol 在同一次遍历中解析，
+    其列追加在 brainvol 指标之后。
+    'io_threads' > 0 时用线程池并发预读取文件内容（适用于高延迟的网络文件系统）。
+    结果在内存中组装好后经临时文件原子地只写一次；'checksum'为True时额外写出'<输出文件>.sha256'。
+    'derived'是'DerivedOptions'，提供时在最后追加标准化体积、不对称指数和离群标记列。
+    'structures'和'measures'是所选的结构列表和指标表，选择会下推给解析器（见'stats_selection'）。
+    'id_pattern'是被试ID的解析规则（见'subject_id_resolver'），各列都按同一个规则连接。
+    'longitudinal'为True时按纵向命名规则以 (被试, 会话) 为行（见'select_sessions'）；
+    'tidy'为True时额外写出长表 total.long.csv。
+    返回输出文件路径。
+    """
+    selection = stats_selection(structures, measures, derived)
+    file_names = selected_file_patterns(stats_file_patterns(tables), selection)
+    cache = None
+    if use_cache:
+        cache = StatsCache(os.path.join(current_folder, CACHE_FILE_NAME), current_folder, cache_hash)
+    try:
+        with PROFILER.stage('discovery'):
+            index = build_stats_index(current_folder, file_names, subjects)
+        with PROFILER.stage('parsing'):
+            subject_stats = collect_subject_stats(current_folder, file_names, jobs, keep_intermediate, cache, index,
+                                                  io_threads, selection)
+    finally:
+        if cache is not None:
+            cache.close()
+    return write_merged(current_folder, subject_stats, output_format, tables, checksum, derived, structures,
+                        measures, id_pattern, longitudinal, tidy)
+
+
+def write_merged(current_folder, subject_stats, output_format='csv', tables=(), checksum=False, derived=None,
+                 structures=None, measures=BRAINVOL_MEASURES, id_pattern=None, longitudinal=False, tidy=False):
+    """
+    把'collect_subject_stats'的结果写为'current_folder'中的 total.csv（或其他格式的 total.*），
+    返回输出文件路径。'merge_all'和'reduce_partials'共用。
+    'checksum'为True时额外写出'<输出文件>.sha256'；'derived'是'DerivedOptions'，提供时追加派生列。
+    'structures'和'measures'是所选的结构列表和指标表；'id_pattern'是被试ID的解析规则。
+    'longitudinal'为True时以 (被试, 会话) 为行；'tidy'为True时由同一份解析结果额外写出长表 total.long.csv。
+    """
+    if longitudinal:
+        subject_stats, sessions = select_sessions(subject_stats)
+        id_pattern = sessions.get
+
+    table = None
+    if output_format != 'csv':
+        # 列式格式：直接由内存中的解析结果构建完整的数值表并写出
+        output_path = os.path.join(current_folder, 'total' + OUTPUT_FORMATS[output_format])
+        with PROFILER.stage('aggregation'):
+            table = build_output_table(subject_stats, measures, tables, derived, structures, id_pattern)
+        with PROFILER.stage('writing'):
+            write_columnar(output_path, output_format, table, checksum, longitudinal)
+        PROFILER.count('rows_written', len(table[1]))
+    else:
+        output_path = os.path.join(current_folder, 'total.csv')
+        write_total_csv(output_path, subject_stats, measures, tables, checksum, derived, structures, id_pattern,
+                        longitudinal)
+
+    if tidy:
+        if table is None:
+            # 宽表CSV保留原始的数值字符串，长表需要数值，由同一份解析结果再构建一次（缺失提示已经打印过）
+            with PROFILER.stage('aggregation'):
+                table = build_output_table(subject_stats, measures, tables, derived, structures, id_pattern,
+                                           report=False)
+        with PROFILER.stage('writing'):
+            write_tidy_csv(os.path.join(current_folder, 'total.long.csv'), table, checksum, longitudinal)
+    return output_path
+
+
+# 'build_csv_table'组装好的、等待写出的 total.csv 内容；各数组都按登记表的行号排列
+CsvTable = namedtuple('CsvTable', ['registry', 'matrix', 'structure_names', 'measures', 'brainvol_values',
+                                   'has_brainvol', 'column_names', 'table_matrix', 'derived_names', 'derived_rows'])
+
+
+def write_total_csv(output_path, subject_stats, measures=BRAINVOL_MEASURES, tables=(), checksum=False,
+                    derived=None, structures=None, id_pattern=None, longitudinal=False):
+    """
+    在内存中组装完整的汇总表（结构体积、brainvol 指标、表格列），经临时文件只写一次。
+    输出与依次调用'main'、'process_brainvol_measures'并追加表格列的结果完全相同，
+    但不再反复读回和重写 total.csv，中途失败也不会留下只写了一部分列的文件。
+    'derived'是'DerivedOptions'，提供时在最后追加派生列（NaN写为空）。
+    'structures'是所选的结构列表，提供时只输出这些结构列。
+    'id_pattern'是被试ID的解析规则（见'subject_id_resolver'），所有列都按登记表的行号连接。
+    'longitudinal'为True时被试ID是 (被试, 会话) 元组，前两列为 subject 和 session。
+    """
+    table = build_csv_table(subject_stats, measures, tables, derived, structures, id_pattern)
+    write_csv_table(output_path, table, checksum, longitudinal)
+
+
+def build_csv_table(subject_stats, measures=BRAINVOL_MEASURES, tables=(), derived=None, structures=None,
+                    id_pattern=None):
+    """'write_total_csv'的聚合步骤：建立被试登记表，组装所有列，返回'CsvTable'。参数含义同'write_total_csv'。"""
+    with PROFILER.stage('aggregation'):
+        registry = SubjectRegistry(subject_stats, id_pattern)
+        report_unresolved(registry.unresolved)
+        matrix, _, structure_index = build_aseg_matrix(subject_stats, structures, registry)
+        if structures is not None:
+            report_missing_structures(matrix, structure_index)
+        brainvol_values, has_brainvol = build_brainvol_values(subject_stats, registry, [key for _, key in measures])
+        column_names, _, _, table_matrix = build_table_columns(subject_stats, tables, registry)
+    derived_rows, derived_names = [[] for _ in registry.subject_ids], []
+    if derived is not None:
+        with PROFILER.stage('derived'):
+            derived_matrix, derived_names, _ = derive_columns(matrix, list(structure_index), subject_stats, registry,
+                                                              measures, derived,
+                                                              build_measure_matrix(brainvol_values))
+            derived_rows = derived_matrix.tolist()
+    return CsvTable(registry, matrix, list(structure_index), measures, brainvol_values, has_brainvol, column_names,
+                    table_matrix, derived_names, derived_rows)
+
+
+def write_csv_table(output_path, table, checksum=False, longitudinal=False):
+    """'write_total_csv'的写出步骤：把'build_csv_table'组装好的'CsvTable'经临时文件写为 total.csv。"""
+    registry, measures = table.registry, table.measures
+    with PROFILER.stage('writing'), atomic_write(output_path, checksum=checksum) as file:
+        writer = csv.writer(file)
+        writer.writerow((list(SESSION_INDEX) if longitudinal else [''])
+                        + table.structure_names + [column for column, _ in measures] + table.column_names
+                        + table.derived_names)
+        # 各列都是按行号排列的数组，逐行直接拼接；tolist() 一次性转换为Python对象，避免逐个访问numpy标量
+        for subject_id, volumes, values, table_values, derived_values in zip(
+                registry.subject_ids, table.matrix.tolist(), table.brainvol_values.tolist(),
+                table.table_matrix.tolist(), table.derived_rows):
+            # 体积和表格中的NaN写为空，缺失的 brainvol 指标写为'N/A'
+            writer.writerow((list(subject_id) if longitudinal else [subject_id])
+                            + ['' if volume != volume else repr(volume) for volume in volumes]
+                            + ['N/A' if value is None else value for value in values]
+                            + ['' if value != value else repr(value) for value in table_values]
+                            + ['' if value != value else repr(value) for value in derived_values])
+    PROFILER.count('rows_written', len(registry) + 1)
+    report_missing_measures(collect_missing_measures(registry.subject_ids, table.brainvol_values, table.has_brainvol,
+                                                     measures), measures)
+
+
+# --- 流式汇总 ---
+#
+# 'merge_all'需要把所有被试的数据都放在内存中，内存占用随被试数量增长。
+# 流式模式先确定固定的列（用户提供的结构列表，或预先扫描一遍所有'aseg.stats'的结构名），
+# 然后每解析完一个被试就立即写出一行，峰值内存与被试数量无关。
+# 对于常规的文件夹结构，输出与'merge_all'完全一致；
+# 不同的是同名被试会各自输出一行，且不在列清单中的结构会被忽略。
+#
+
+def scan_structure_names(root_dir, index=None):
+    """
+    第一遍扫描：读取所有'aseg.stats'中的结构名，按首次出现的顺序返回。
+    'index'是'build_stats_index'的结果，传入时不再重新遍历文件夹。
+    """
+    if index is None:
+        index = iter_stats_dirs(root_dir, ('aseg.stats',))
+    structure_names = {}  # 用字典保持首次出现的顺序
+    for stats_dir, _ in select_stats_files(index, ('aseg.stats',)):
+        aseg_records = parse_aseg_records(os.path.join(stats_dir, 'aseg.stats'))
+        for struct_name, _ in aseg_records or ():
+            structure_names.setdefault(struct_name, None)
+    return list(structure_names)
+
+
+def iter_parsed_stats(root_dir, jobs=1, file_names=STATS_FILE_NAMES, index=None, io_threads=0, selection=None):
+    """
+    按遍历顺序逐个产出 (文件夹路径, aseg记录, brainvol指标, {表格名: 记录})。
+    'index'是'build_stats_index'的结果，传入时不再重新遍历文件夹。
+    'io_threads' > 0 时用线程池并发预读取文件内容。
+    'selection'是'StatsSelection'，提供时只解析所需的结构和度量键。
+    'jobs' > 1 时并行解析，但同时在处理中的任务数有上限，内存占用保持恒定。
+    """
+    if index is None:
+        index = iter_stats_dirs(root_dir, file_names)
+    read_tasks = iter_read_tasks(select_stats_files(index, file_names), io_threads, selection)
+    if jobs <= 1:
+        for stats_dir, names, contents in read_tasks:
+            yield (stats_dir,) + split_parsed_stats(parse_subject_stats(stats_dir, names, contents=contents,
+                                                                        selection=selection))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    window = jobs * 4  # 同时提交给进程池的最大任务数
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = deque()  # [(文件夹路径, future), ...]，按提交顺序排列
+        for stats_dir, names, contents in read_tasks:
+            futures.append((stats_dir, executor.submit(parse_subject_stats, stats_dir, names, contents=contents,
+                                                         selection=selection)))
+            if len(futures) >= window:
+                stats_dir, future = futures.popleft()
+                yield (stats_dir,) + split_parsed_stats(future.result())
+        while futures:
+            stats_dir, future = futures.popleft()
+            yield (stats_dir,) + split_parsed_stats(future.result())
+
+
+def merge_streaming(current_folder, structures=None, jobs=1, measures=BRAINVOL_MEASURES, subjects=None,
+                    io_threads=0, checksum=False, id_pattern=None):
+    """
+    以流式方式生成 total.csv：每个被试解析完后立即写出一行。
+    'structures'是固定的结构列清单，不传入时先扫描一遍所有'aseg.stats'确定。
+    'subjects'是被试文件夹列表，提供时只处理这些被试。
+    'io_threads' > 0 时用线程池并发预读取文件内容。
+    'structures'由用户提供时和'measures'一起下推给解析器，只解析所需的结构和度量键。
+    'id_pattern'是被试ID的解析规则（见'subject_id_resolver'），无法解析的文件夹被跳过。
+    各行先写入临时文件，全部完成后才原子替换 total.csv；'checksum'为True时额外写出'total.csv.sha256'。
+    返回输出文件路径。
+    """
+    output_path = os.path.join(current_folder, 'total.csv')
+    selection = stats_selection(structures, measures)
+    file_names = selected_file_patterns(STATS_FILE_NAMES, selection)
+    index = None
+    if structures is None:
+        # 需要两遍处理时，先构建一次索引，扫描和解析共用
+        with PROFILER.stage('discovery'):
+            index = build_stats_index(current_folder, file_names, subjects)
+        with PROFILER.stage('schema_scan'):
+            structures = scan_structure_names(current_folder, index)
+    elif subjects is not None:
+        index = iter_listed_stats_dirs(current_folder, subjects, file_names)
+    structure_index = {struct_name: i for i, struct_name in enumerate(structures)}
+    resolve_id = subject_id_resolver(id_pattern)
+    unresolved = []
+
+    rows_written = 0
+    missing = {}
+    with PROFILER.stage('streaming'), atomic_write(output_path, checksum=checksum) as file:
+        writer = csv.writer(file)
+        # 表头：第一格留空，然后是结构名和 brainvol 指标列名
+        writer.writerow([''] + list(structures) + [column for column, _ in measures])
+        for stats_dir, aseg_records, brainvol_measures, _ in iter_parsed_stats(current_folder, jobs, file_names, index,
+                                                                                io_threads, selection):
+            # 与'main'一致，只为有 aseg.stats 数据的被试输出行
+            if aseg_records is None:
+                continue
+            folder_name = resolve_id(stats_dir)
+            if folder_name is None:
+                unresolved.append(stats_dir)
+                continue
+            volumes = [''] * len(structures)  # 缺失的结构留空
+            for struct_name, volume in aseg_records:
+                column = structure_index.get(struct_name)
+                if column is not None:
+                    volumes[column] = repr(volume)
+            note_missing_measures(missing, folder_name, brainvol_measures, measures)
+            brainvol_measures = brainvol_measures or {}
+            writer.writerow([folder_name] + volumes + [brainvol_measures.get(key, 'N/A') for _, key in measures])
+            rows_written += 1
+    PROFILER.count('rows_written', rows_written + 1)
+    report_unresolved(unresolved)
+    report_missing_measures(missing, measures)
+
+    return output_path
+
+
+# --- 逐个被试追加 ---
+#
+# 新被试在一天中陆续完成'recon-all'，每来一个被试就重新汇总整个文件夹的代价太高。
+# 'Aggregator'只解析新被试自己的stats文件，在现有的 total.csv 中追加一行，
+# 或者替换同名被试的已有行（upsert），不读取其他被试的stats文件。
+# 新被试带来新的结构时，在结构列的末尾（brainvol 指标列之前）插入新列，已有的行在该列留空；
+# 新的表格列追加在最后。
+# 只有新增行、且列没有变化时，'flush'直接以追加模式写入文件末尾，否则整体重写一次。
+#
+
+class Aggregator:
+    """
+    向已有的 total.csv 逐个追加或更新被试。
+    'output_path'不存在时在第一次'flush'时创建；'measures'和'tables'与'merge_all'的含义相同。
+    'id_pattern'是被试ID的解析规则（见'subject_id_resolver'），应与生成汇总文件时一致。
+    """
+
+    def __init__(self, output_path, measures=BRAINVOL_MEASURES, tables=(), id_pattern=None):
+        self.output_path = output_path
+        self.resolve_id = subject_id_resolver(id_pattern)
+        self.measures = measures
+        self.tables = tables
+        self.file_names = stats_file_patterns(tables)
+        self.measure_columns = {column for column, _ in measures}
+        self.headers = [''] + [column for column, _ in measures]
+        self.rows = []  # 已有的行和新增的行，每行是单元格字符串列表
+        self.row_index = {}  # {被试ID: 行号}，同名被试以第一次出现的行为准
+        self.n_structures = 0  # 结构列的数量，位于表头第一格之后
+        self.n_flushed = 0  # 文件中已有的行数，之后的行可以直接追加
+        self.rewrite = True  # 文件不存在、列发生变化或已有行被更新时需要整体重写
+        self.missing = {}  # 'note_missing_measures'的记录，'flush'时报告
+        if os.path.exists(output_path):
+            self._load()
+
+    def _load(self):
+        """读取现有的汇总文件，确定结构列的范围。"""
+        with open(self.output_path, 'r', newline='') as csvfile:
+            csvreader = csv.reader(csvfile)
+            self.headers = next(csvreader)
+            self.rows = list(csvreader)
+        for row, cells in enumerate(self.rows):
+            self.row_index.setdefault(cells[0], row)
+        # 结构列从第二格开始，到第一个 brainvol 指标列为止
+        self.n_structures = next((i for i, column in enumerate(self.headers[1:]) if column in self.measure_columns),
+                                 len(self.headers) - 1)
+        # 文件中缺少的指标列追加在最后
+        for column, _ in self.measures:
+            if column not in self.headers:
+                self._add_column(len(self.headers), column, 'N/A')
+        self.n_flushed = len(self.rows)
+        self.rewrite = False
+
+    def _add_column(self, position, column, fill):
+        """在'position'处插入新列，已有的行填入'fill'。"""
+        self.headers.insert(position, column)
+        for cells in self.rows:
+            cells.insert(position, fill)
+        self.rewrite = True
+
+    def add_subject(self, subject_dir):
+        """
+        解析一个被试文件夹（其中的'stats/'）并追加或更新它的行。
+        返回被试ID；找不到 aseg.stats 数据或无法解析被试ID时打印提示并返回None。
+        """
+        subject_dir = os.path.normpath(subject_dir)
+        index = list(iter_listed_stats_dirs(os.path.dirname(subject_dir), [os.path.basename(subject_dir)],
+                                            self.file_names))
+        subject_stats = collect_subject_stats(subject_dir, self.file_names, index=index)
+        if not subject_stats or subject_stats[0][1] is None:
+            print(f"跳过被试 {subject_dir}，因为找不到 aseg.stats 数据")
+            return None
+        stats_dir, aseg_records, brainvol_measures, _ = subject_stats[0]
+        subject_id = self.resolve_id(stats_dir)
+        if subject_id is None:
+            # 不能退回文件夹名：例如 BIDS 的'ses-01'会与其他被试的同名文件夹冲突，覆盖已有的行
+            print(f"跳过被试 {subject_dir}，因为无法按被试ID规则解析其ID")
+            return None
+
+        # 各列的单元格，格式与'merge_all'的输出相同
+        cells = {struct_name: repr(volume) for struct_name, volume in aseg_records}
+        note_missing_measures(self.missing, subject_id, brainvol_measures, self.measures)
+        cells.update((column, (brainvol_measures or {}).get(key, 'N/A')) for column, key in self.measures)
+        column_names, _, _, table_matrix = build_table_columns(subject_stats[:1], self.tables)
+        cells.update((column, '' if value != value else repr(value))
+                     for column, value in zip(column_names, table_matrix[0].tolist()))
+
+        # 新的结构列插入在结构列末尾，其他新列追加在最后
+        for struct_name, _ in aseg_records:
+            if struct_name not in self.headers[1:self.n_structures + 1]:
+                self._add_column(self.n_structures + 1, struct_name, '')
+                self.n_structures += 1
+        for column in column_names:
+            if column not in self.headers:
+                self._add_column(len(self.headers), column, '')
+
+        row = [subject_id] + [cells.get(column, '') for column in self.headers[1:]]
+        if subject_id in self.row_index:
+            self.rows[self.row_index[subject_id]] = row
+            if self.row_index[subject_id] < self.n_flushed:
+                self.rewrite = True
+        else:
+            self.row_index[subject_id] = len(self.rows)
+            self.rows.append(row)
+        return subject_id
+
+    def flush(self):
+        """把新增或更新的行写入汇总文件，返回文件路径。"""
+        if self.rewrite:
+            with atomic_write(self.output_path) as csvfile:
+                csvwriter = csv.writer(csvfile)
+                csvwriter.writerow(self.headers)
+                csvwriter.writerows(self.rows)
+            PROFILER.count('rows_written', len(self.rows) + 1)
+        else:
+            # 只有新增的行：在内存中格式化后一次写入文件末尾并fsync，不重写已有内容
+            buffer = io.StringIO(newline='')
+            csv.writer(buffer).writerows(self.rows[self.n_flushed:])
+            with open(self.output_path, 'a', newline='') as csvfile:
+                csvfile.write(buffer.getvalue())
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+            PROFILER.count('rows_written', len(self.rows) - self.n_flushed)
+        self.n_flushed = len(self.rows)
+        self.rewrite = False
+        report_missing_measures(self.missing, self.measures)
+        self.missing = {}
+        return self.output_path
+
+
+# --- 分片汇总（map/reduce） ---
+#
+# 多中心研究的被试分布在多个存储卷和计算节点上时，可以把汇总拆成两步：
+# 1. map：每个节点都遍历同一个根目录（遍历很快），按stats文件夹相对路径的哈希只解析属于自己分片的被试，
+#    把解析结果写为一个分片文件（NPZ，只依赖NumPy）；
+# 2. reduce：读取所有分片文件，按遍历顺序合并后用与'merge_all'相同的代码写出最终结果。
+# 分片文件中每个被试保存一行，同时保存每一格是否存在，
+# 因此合并后的结构列顺序、同名被试的覆盖规则都与单节点运行完全一致。
+#
+
+PARTIAL_FORMAT_VERSION = 1
+
+
+def parse_shard(text):
+    """把'i/N'解析为 (i, N)，要求 0 <= i < N。"""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"分片应写作 i/N，例如 0/4，而不是 '{text}'")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"分片编号应满足 0 <= i < N，而不是 '{text}'")
+    return index, count
+
+
+def shard_of(key, n_shards):
+    """按'key'（stats文件夹相对于根目录的路径）的MD5确定所属分片，与运行环境和Python的哈希随机化无关。"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big') % n_shards
+
+
+def _pack_records(records_list, width=None):
+    """
+    把每行一个（或None）的'StatsRecords'打包为列式数组：
+    返回 (键数组, 数值矩阵, 每格是否存在, 每行是否有记录)，键按首次出现的顺序排列。
+    """
+    key_index = {}
+    for records in records_list:
+        for key in records.keys if records is not None else ():
+            key_index.setdefault(key, len(key_index))
+    step = width or 1
+    values = np.full((len(records_list), len(key_index) * step), np.nan, dtype=np.float64)
+    present = np.zeros((len(records_list), len(key_index)), dtype=bool)
+    for row, records in enumerate(records_list):
+        if records is None:
+            continue
+        columns = np.array([key_index[key] for key in records.keys], dtype=np.intp)
+        present[row, columns] = True
+        # 每个键占'step'列，按行优先展开
+        cells = (columns[:, None] * step + np.arange(step)).ravel()
+        values[row, cells] = np.frombuffer(records.values, dtype=np.float64)
+    has_records = np.array([records is not None for records in records_list], dtype=bool)
+    return np.array(list(key_index), dtype=str), values, present, has_records
+
+
+def _unpack_records(keys, values, present, has_records, width=None):
+    """'_pack_records'的逆操作，返回每行的'StatsRecords'（或None）列表。"""
+    step = width or 1
+    records_list = []
+    for row in range(len(has_records)):
+        if not has_records[row]:
+            records_list.append(None)
+            continue
+        columns = np.flatnonzero(present[row])
+        cells = (columns[:, None] * step + np.arange(step)).ravel()
+        records_list.append(StatsRecords(keys[columns].tolist(), values[row, cells], width))
+    return records_list
+
+
+def write_partial(output_path, subject_stats, positions, shard, tables=()):
+    """
+    把一个分片的解析结果写为NPZ分片文件。
+    'positions'是每个文件夹在完整遍历顺序中的位置，'shard'是 (i, N)。
+    """
+    arrays = {
+        'version': np.array(PARTIAL_FORMAT_VERSION),
+        'shard': np.array(shard, dtype=np.int64),
+        'tables': np.array(list(tables), dtype=str),
+        'positions': np.array(positions, dtype=np.int64),
+        'stats_dirs': np.array([stats_dir for stats_dir, _, _, _ in subject_stats], dtype=str),
+    }
+    arrays['aseg_keys'], arrays['aseg_values'], arrays['aseg_present'], arrays['aseg_rows'] = _pack_records(
+        [aseg_records for _, aseg_records, _, _ in subject_stats])
+    # aseg 文件头指标（'ASEG_HEADER_MEASURES'）保留原始字符串，缺失为空字符串
+    arrays['aseg_header'] = np.array([[(aseg_records.measures or {}).get(key, '') if aseg_records is not None else ''
+                                       for key in ASEG_HEADER_MEASURES]
+                                      for _, aseg_records, _, _ in subject_stats],
+                                     dtype=str).reshape(len(subject_stats), len(ASEG_HEADER_MEASURES))
+
+    # brainvol 指标保留原始字符串
+    measure_index = {}
+    for _, _, brainvol_measures, _ in subject_stats:
+        for key in brainvol_measures or ():
+            measure_index.setdefault(key, len(measure_index))
+    measure_values = [[''] * len(measure_index) for _ in subject_stats]
+    measure_present = np.zeros((len(subject_stats), len(measure_index)), dtype=bool)
+    for row, (_, _, brainvol_measures, _) in enumerate(subject_stats):
+        for key, value in (brainvol_measures or {}).items():
+            measure_values[row][measure_index[key]] = value
+            measure_present[row, measure_index[key]] = True
+    arrays['measure_keys'] = np.array(list(measure_index), dtype=str)
+    arrays['measure_values'] = np.array(measure_values, dtype=str).reshape(len(subject_stats), len(measure_index))
+    arrays['measure_present'] = measure_present
+    arrays['measure_rows'] = np.array([item[2] is not None for item in subject_stats], dtype=bool)
+
+    for table_name in tables:
+        width = len(STATS_TABLES[table_name].value_columns)
+        packed = _pack_records([table_records.get(table_name) for _, _, _, table_records in subject_stats], width)
+        for suffix, array_ in zip(('keys', 'values', 'present', 'rows'), packed):
+            arrays[f'table_{table_name}_{suffix}'] = array_
+
+    with atomic_write(output_path, 'wb') as file:
+        np.savez(file, **arrays)
+
+
+def read_partial(partial_path):
+    """读取一个分片文件，返回 ((i, N), 表格名列表, 遍历位置列表, 解析结果列表)。"""
+    with np.load(partial_path) as data:
+        if int(data['version']) != PARTIAL_FORMAT_VERSION:
+            raise ValueError(f"分片文件 {partial_path} 的格式版本不受支持")
+        shard = tuple(data['shard'].tolist())
+        tables = data['tables'].tolist()
+        stats_dirs = data['stats_dirs'].tolist()
+        aseg = _unpack_records(data['aseg_keys'], data['aseg_values'], data['aseg_present'], data['aseg_rows'])
+        if 'aseg_header' in data.files:
+            for records, cells in zip(aseg, data['aseg_header'].tolist()):
+                header = {key: value for key, value in zip(ASEG_HEADER_MEASURES, cells) if value}
+                if records is not None and header:
+                    records.measures = MeasureValues.from_dict(header)
+        measure_keys = data['measure_keys'].tolist()
+        brainvol = []
+        for values, present, has_measures in zip(data['measure_values'].tolist(), data['measure_present'],
+                                                 data['measure_rows']):
+            brainvol.append(MeasureValues([key for key, flag in zip(measure_keys, present) if flag],
+                                          [value for value, flag in zip(values, present) if flag])
+                            if has_measures else None)
+        table_records = [{} for _ in stats_dirs]
+        for table_name in tables:
+            prefix = f'table_{table_name}_'
+            unpacked = _unpack_records(data[prefix + 'keys'], data[prefix + 'values'], data[prefix + 'present'],
+                                       data[prefix + 'rows'], len(STATS_TABLES[table_name].value_columns))
+            for row, records in enumerate(unpacked):
+                if records is not None:
+                    table_records[row][table_name] = records
+        positions = data['positions'].tolist()
+    return shard, tables, positions, list(zip(stats_dirs, aseg, brainvol, table_records))
+
+
+def map_shard(current_folder, shard, output_path=None, jobs=1, subjects=None, tables=(), io_threads=0):
+    """
+    只解析属于分片 'shard'（(i, N)）的被试，写出分片文件并返回其路径。
+    分片文件默认写在'current_folder'中，文件名为 total.part-i-of-N.npz。
+    """
+    index_, n_shards = shard
+    if output_path is None:
+        output_path = os.path.join(current_folder, f'total.part-{index_}-of-{n_shards}.npz')
+    file_names = stats_file_patterns(tables)
+    with PROFILER.stage('discovery'):
+        index = build_stats_index(current_folder, file_names, subjects)
+    # 按stats文件夹的相对路径分片：路径对每个条目唯一，BIDS 的'sub-*/ses-01'也能均匀分布，
+    # 不像文件夹名那样全部落入同一个分片。保留完整遍历顺序中的位置，供 reduce 恢复与单节点相同的顺序
+    selected = [(position, entry) for position, entry in enumerate(index)
+                if shard_of(os.path.relpath(entry[0], current_folder).replace(os.sep, '/'), n_shards) == index_]
+    with PROFILER.stage('parsing'):
+        subject_stats = collect_subject_stats(current_folder, file_names, jobs, index=[entry for _, entry in selected],
+                                              io_threads=io_threads)
+    with PROFILER.stage('writing'):
+        write_partial(output_path, subject_stats, [position for position, _ in selected], shard, tables)
+    return output_path
+
+
+def reduce_partials(partial_paths, current_folder, output_format='csv', checksum=False, derived=None,
+                    id_pattern=None, longitudinal=False, tidy=False):
+    """
+    合并所有分片文件，在'current_folder'中写出与单节点运行相同的 total.csv（或其他格式），返回输出文件路径。
+    'id_pattern'是被试ID的解析规则（见'subject_id_resolver'）；'longitudinal'和'tidy'与'merge_all'相同。
+    分片不完整、重复或表格不一致时抛出ValueError。
+    """
+    merged = []  # [(遍历位置, 分片编号, 解析结果), ...]
+    shards = {}
+    table_sets = set()
+    with PROFILER.stage('parsing'):
+        for partial_path in partial_paths:
+            (index_, n_shards), tables, positions, subject_stats = read_partial(partial_path)
+            if (index_, n_shards) in shards:
+                raise ValueError(f"分片 {index_}/{n_shards} 重复: {shards[(index_, n_shards)]} 和 {partial_path}")
+            shards[(index_, n_shards)] = partial_path
+            table_sets.add(tuple(tables))
+            merged.extend((position, index_, item) for position, item in zip(positions, subject_stats))
+    counts = {n_shards for _, n_shards in shards}
+    if len(counts) != 1:
+        raise ValueError(f"分片文件的分片总数不一致: {sorted(counts)}")
+    n_shards = counts.pop()
+    missing = sorted(set(range(n_shards)) - {index_ for index_, _ in shards})
+    if missing:
+        raise ValueError(f"缺少分片: {', '.join(f'{index_}/{n_shards}' for index_ in missing)}")
+    if len(table_sets) != 1:
+        raise ValueError('分片文件提取的表格不一致')
+
+    merged.sort(key=lambda item: item[:2])
+    return write_merged(current_folder, [item for _, _, item in merged], output_format, list(table_sets.pop()),
+                        checksum, derived, id_pattern=id_pattern, longitudinal=longitudinal, tidy=tidy)
+
+
+# --- 脚本入口点 ---
+# 当这个 .py 文件被直接执行时（而不是作为模块导入时），下面的代码块会运行
+if __name__ == "__main__" and sys.argv[1:2] == ['add']:
+    # 'merge.py add <被试文件夹> ...'：只解析这些被试，追加或更新到已有的汇总文件
+    # （名为'add'、'map'或'reduce'的根目录请写作'./add'等）
+    parser = argparse.ArgumentParser(prog='merge.py add',
+                                     description='把一个或多个新被试追加或更新到已有的 total.csv，不重新汇总其他被试')
+    parser.add_argument('subject_dirs', nargs='+', help='被试文件夹（其中包含 stats/）')
+    parser.add_argument('-o', '--output',
+                        help='要更新的汇总文件（默认为第一个被试文件夹所在目录中的 total.csv）')
+    parser.add_argument('--tables', type=lambda text: [name for name in text.split(',') if name], default=[],
+                        help='额外提取的stats表格，逗号分隔，应与生成汇总文件时一致')
+    parser.add_argument('--subject-id-pattern', help=SUBJECT_ID_PATTERN_HELP + '，应与生成汇总文件时一致')
+    args = parser.parse_args(sys.argv[2:])
+    unknown_tables = [name for name in args.tables if name not in STATS_TABLES]
+    if unknown_tables:
+        parser.error(f"未知的表格: {', '.join(unknown_tables)}")
+    try:
+        subject_id_resolver(args.subject_id_pattern)
+    except re.error as error:
+        parser.error(f"无效的被试ID正则表达式: {error}")
+
+    output_csv_path = args.output or os.path.join(os.path.dirname(os.path.normpath(args.subject_dirs[0])),
+                                                  'total.csv')
+    aggregator = Aggregator(output_csv_path, tables=args.tables, id_pattern=args.subject_id_pattern)
+    added = [subject_id for subject_id in map(aggregator.add_subject, args.subject_dirs) if subject_id is not None]
+    aggregator.flush()
+    print(f"处理完成！{len(added)} 个被试已更新到 {output_csv_path}")
+
+elif __name__ == "__main__" and sys.argv[1:2] == ['map']:
+    # 'merge.py map <根目录> --shard i/N'：只解析一个分片的被试，写出分片文件
+    parser = argparse.ArgumentParser(prog='merge.py map', description='按stats文件夹相对路径的哈希只解析一个分片，写出分片文件')
+    parser.add_argument('folder_path', help='包含所有被试文件夹的根目录')
+    parser.add_argument('--shard', type=parse_shard, required=True, help='分片编号 i/N（0 <= i < N）')
+    parser.add_argument('-o', '--output', help='分片文件路径（默认为根目录中的 total.part-i-of-N.npz）')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='并行解析使用的进程数（默认1，即串行）')
+    parser.add_argument('--io-threads', type=int, default=0, help='并发预读取 stats 文件的线程数（默认0）')
+    parser.add_argument('--subjects-file', help='被试列表文件（每行一个相对于根目录的被试文件夹）')
+    parser.add_argument('--tables', type=lambda text: [name for name in text.split(',') if name], default=[],
+                        help='额外提取的stats表格，逗号分隔，可选: ' + ', '.join(STATS_TABLES))
+    args = parser.parse_args(sys.argv[2:])
+    unknown_tables = [name for name in args.tables if name not in STATS_TABLES]
+    if unknown_tables:
+        parser.error(f"未知的表格: {', '.join(unknown_tables)}")
+
+    subjects = read_name_list(args.subjects_file) if args.subjects_file else None
+    partial_path = map_shard(args.folder_path, args.shard, args.output, jobs=args.jobs, subjects=subjects,
+                             tables=args.tables, io_threads=args.io_threads)
+    print(f"分片 {args.shard[0]}/{args.shard[1]} 处理完成！已写出 {partial_path}")
+
+elif __name__ == "__main__" and sys.argv[1:2] == ['reduce']:
+    # 'merge.py reduce <分片文件> ... -o <文件夹>'：合并所有分片，写出最终的汇总文件
+    parser = argparse.ArgumentParser(prog='merge.py reduce', description='合并 map 写出的所有分片文件')
+    parser.add_argument('partial_paths', nargs='+', help='所有分片文件')
+    parser.add_argument('-o', '--output-folder', default='.', help='写出 total.* 的文件夹（默认当前文件夹）')
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='csv',
+                        help='输出格式（默认csv）；parquet 和 feather 需要安装 pyarrow，'
+                             'sqlite 写出包含宽表 total 和长表 measurements 的数据库')
+    parser.add_argument('--checksum', action='store_true', help='额外写出输出文件的 SHA-256 校验文件（<输出文件>.sha256）')
+    parser.add_argument('--derived', action='store_true',
+                        help='追加派生列：按参考体积标准化的结构体积、左右不对称指数和稳健z分数离群标记')
+    parser.add_argument('--derived-reference', choices=list(DERIVED_REFERENCES), default='Mask',
+                        help='标准化体积使用的参考体积（默认Mask）')
+    parser.add_argument('--outlier-threshold', type=float, default=3.5,
+                        help='稳健z分数的离群阈值（默认3.5）')
+    parser.add_argument('--subject-id-pattern', help=SUBJECT_ID_PATTERN_HELP)
+    parser.add_argument('--longitudinal', action='store_true', help=LONGITUDINAL_HELP)
+    parser.add_argument('--tidy', action='store_true', help=TIDY_HELP)
+    args = parser.parse_args(sys.argv[2:])
+    if args.longitudinal and args.subject_id_pattern:
+        parser.error('--longitudinal 按 FreeSurfer 的纵向命名规则解析被试和会话，不能与 --subject-id-pattern 同时使用')
+    try:
+        subject_id_resolver(args.subject_id_pattern)
+    except re.error as error:
+        parser.error(f"无效的被试ID正则表达式: {error}")
+    derived = DerivedOptions(args.derived_reference, args.outlier_threshold) if args.derived else None
+    try:
+        output_path = reduce_partials(args.partial_paths, args.output_folder, args.format, args.checksum, derived,
+                                      args.subject_id_pattern, args.longitudinal, args.tidy)
+    except ValueError as error:
+        parser.error(str(error))
+    print(f"处理完成！所有数据已汇总到 {output_path}")
+
+elif __name__ == "__main__":
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description='汇总FreeSurfer的aseg.stats和brainvol.stats数据到total.csv')
+    parser.add_argument('folder_path', help='包含所有被试文件夹的根目录')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='并行解析使用的进程数（默认1，即串行）')
+    parser.add_argument('--io-threads', type=int, default=0,
+                        help='并发预读取 stats 文件的线程数（默认0，即不预读取），适用于高延迟的网络文件系统')
+    parser.add_argument('--keep-intermediate', action='store_true',
+                        help="在每个 aseg.stats 旁边额外写出 aseg.stats.csv 中间文件")
+    parser.add_argument('--cache', action='store_true',
+                        help=f'使用 {CACHE_FILE_NAME} 增量缓存，只解析新增或变化的 stats 文件')
+    parser.add_argument('--cache-hash', action='store_true',
+                        help='缓存额外比较文件内容哈希（修改时间不可靠时使用，隐含 --cache）')
+    parser.add_argument('--subjects-file',
+                        help='被试列表文件（每行一个相对于根目录的被试文件夹），提供时不遍历根目录')
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='csv',
+                        help='输出格式（默认csv）；parquet 和 feather 需要安装 pyarrow，'
+                             'sqlite 写出包含宽表 total 和长表 measurements 的数据库')
+    parser.add_argument('--tables', type=lambda text: [name for name in text.split(',') if name], default=[],
+                        help='额外提取的stats表格，逗号分隔，可选: ' + ', '.join(STATS_TABLES))
+    parser.add_argument('--checksum', action='store_true', help='额外写出输出文件的 SHA-256 校验文件（<输出文件>.sha256）')
+    parser.add_argument('--derived', action='store_true',
+                        help='追加派生列：按参考体积标准化的结构体积、左右不对称指数和稳健z分数离群标记')
+    parser.add_argument('--derived-reference', choices=list(DERIVED_REFERENCES), default='Mask',
+                        help='标准化体积使用的参考体积（默认Mask）')
+    parser.add_argument('--outlier-threshold', type=float, default=3.5,
+                        help='稳健z分数的离群阈值（默认3.5）')
+    parser.add_argument('--stream', action='store_true',
+                        help='流式模式：每个被试解析完立即写出一行，内存占用与被试数量无关')
+    parser.add_argument('--schema-file',
+                        help='流式模式使用的结构列表文件（每行一个结构名），不提供时先扫描一遍确定')
+    parser.add_argument('--structures', type=parse_name_list,
+                        help='只提取这些 aseg 结构，逗号分隔或 @<文件>（每行一个），按给出的顺序输出')
+    parser.add_argument('--measures', type=parse_name_list,
+                        help='只提取这些 brainvol 指标（输出列名或度量键），逗号分隔或 @<文件>，按给出的顺序输出；'
+                             '为空时不读取 brainvol.stats')
+    parser.add_argument('--subject-id-pattern', help=SUBJECT_ID_PATTERN_HELP)
+    parser.add_argument('--longitudinal', action='store_true', help=LONGITUDINAL_HELP)
+    parser.add_argument('--tidy', action='store_true', help=TIDY_HELP)
+    parser.add_argument('--profile', action='store_true',
+                        help='打印各阶段耗时和计数的汇总表，并写出JSON指标文件')
+    parser.add_argument('--profile-cpu', action='store_true',
+                        help='同时使用cProfile记录函数级耗时（隐含 --profile）')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='同时使用tracemalloc记录每个阶段的内存峰值（隐含 --profile）')
+    parser.add_argument('--metrics-file',
+                        help='JSON指标文件的路径（默认为输出文件夹中的 total.metrics.json）')
+    args = parser.parse_args()
+    if args.stream and (args.cache or args.cache_hash or args.keep_intermediate):
+        parser.error('--stream 不能与 --cache、--cache-hash 或 --keep-intermediate 同时使用')
+    if args.stream and args.format != 'csv':
+        parser.error('--stream 只支持 csv 格式')
+    if args.stream and args.tables:
+        parser.error('--stream 不支持 --tables')
+    if args.stream and args.derived:
+        parser.error('--stream 不支持 --derived（派生列需要所有被试的数据）')
+    if args.stream and (args.longitudinal or args.tidy):
+        parser.error('--stream 不支持 --longitudinal 和 --tidy')
+    if args.longitudinal and args.subject_id_pattern:
+        parser.error('--longitudinal 按 FreeSurfer 的纵向命名规则解析被试和会话，不能与 --subject-id-pattern 同时使用')
+    unknown_tables = [name for name in args.tables if name not in STATS_TABLES]
+    if unknown_tables:
+        parser.error(f"未知的表格: {', '.join(unknown_tables)}")
+    if args.schema_file and not args.stream:
+        parser.error('--schema-file 只能在 --stream 模式下使用')
+    if args.schema_file and args.structures is not None:
+        parser.error('--schema-file 不能与 --structures 同时使用')
+    measures = BRAINVOL_MEASURES if args.measures is None else resolve_measures(args.measures)
+    try:
+        subject_id_resolver(args.subject_id_pattern)
+    except re.error as error:
+        parser.error(f"无效的被试ID正则表达式: {error}")
+
+    # 获取命令行提供的文件夹路径和可选的被试列表
+    current_folder = args.folder_path
+    subjects = read_name_list(args.subjects_file) if args.subjects_file else None
+
+    # 按需开启性能统计
+    profile = args.profile or args.profile_cpu or args.profile_memory
+    if profile:
+        PROFILER.enable(cpu=args.profile_cpu, memory=args.profile_memory)
+
+    if args.stream:
+        # 流式生成 total.csv，列由结构列表文件或预扫描确定
+        structures = read_name_list(args.schema_file) if args.schema_file else args.structures
+        output_csv_path = merge_streaming(current_folder, structures=structures, jobs=args.jobs, measures=measures,
+                                          subjects=subjects, io_threads=args.io_threads, checksum=args.checksum,
+                                          id_pattern=args.subject_id_pattern)
+    else:
+        # 生成 total.csv：aseg.stats 的体积和 brainvol.stats 的各项指标在内存中组装后只写一次
+        output_csv_path = merge_all(current_folder, jobs=args.jobs, keep_intermediate=args.keep_intermediate,
+                                    use_cache=args.cache or args.cache_hash, cache_hash=args.cache_hash,
+                                    output_format=args.format, subjects=subjects, tables=args.tables,
+                                    io_threads=args.io_threads, checksum=args.checksum,
+                                    derived=DerivedOptions(args.derived_reference, args.outlier_threshold)
+                                    if args.derived else None,
+                                    structures=args.structures, measures=measures,
+                                    id_pattern=args.subject_id_pattern, longitudinal=args.longitudinal,
+                                    tidy=args.tidy)
+
+    print(f"处理完成！所有数据已汇总到 {output_csv_path}")
+
+    if profile:
+        PROFILER.finish()
+        PROFILER.print_summary()
+        metrics_path = args.metrics_file or os.path.join(current_folder, 'total.metrics.json')
+        PROFILER.write(metrics_path, os.path.splitext(metrics_path)[0] + '.pstats')
+        print(f"性能指标已写入 {metrics_path}")